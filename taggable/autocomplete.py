@@ -0,0 +1,212 @@
+"""Taggable autocompletion, in memory prefix indexes of tag names
+
+Every tagged model has an :class:`Autocomplete` with the indexes of the
+warmed scopes (combinations of tagged field values). The indexes are
+updated with the added and removed tagged rows, and they are reloaded after
+``Taggable.autocomplete_ttl`` seconds, since the rows of rolled back
+transactions are counted too.
+"""
+
+import bisect
+import heapq
+import threading
+import time
+
+from taggable import stats
+from taggable.querysets import _build_tags
+
+
+class PrefixIndex(object):
+    "Lowercase tag names of a scope, sorted for prefix searches, and counts."
+
+    def __init__(self, expires):
+        self.expires = expires
+        # sorted (lowercase name, pk) tuples
+        self.keys = []
+        # {pk: count}
+        self.counts = {}
+
+    def add(self, key, pk, delta):
+        "Adds ``delta`` to the count of a tag."
+        count = self.counts.get(pk)
+        if count is None:
+            if delta <= 0:
+                return
+            bisect.insort(self.keys, (key, pk))
+            count = 0
+        count += delta
+        if count > 0:
+            self.counts[pk] = count
+            return
+        self.remove(key, pk)
+
+    def remove(self, key, pk):
+        if self.counts.pop(pk, None) is None:
+            return
+        pos = bisect.bisect_left(self.keys, (key, pk))
+        if pos < len(self.keys) and self.keys[pos] == (key, pk):
+            del self.keys[pos]
+
+    def search(self, prefix, top):
+        """Returns the ``(pk, count)`` of the tags starting with ``prefix``.
+
+        Ordered by count, then by primary key, like the SQL queries.
+        """
+        matches = []
+        pos = bisect.bisect_left(self.keys, (prefix, ))
+        while pos < len(self.keys) and self.keys[pos][0].startswith(prefix):
+            pk = self.keys[pos][1]
+            matches.append((-self.counts[pk], pk))
+            pos += 1
+        if top:
+            matches = heapq.nsmallest(top, matches)
+        else:
+            matches.sort()
+        return [(tagpk, -count) for count, tagpk in matches]
+
+
+def scope_key(fields):
+    "Returns the index key of a dict of tagged fields."
+    return tuple(sorted([(field, stats.field_value(value))
+                         for field, value in fields.items()]))
+
+
+class Autocomplete(object):
+    """The prefix indexes of a tagged model.
+
+    ``name`` is the indexed tag field, ``ttl`` the seconds an index is used
+    before being reloaded, and ``scopes`` the maximum number of indexes.
+    """
+
+    def __init__(self, cls, name, ttl, scopes):
+        self.cls = cls
+        self.name = name
+        self.ttl = ttl
+        self.scopes = scopes
+        # {scope key: PrefixIndex}
+        self.indexes = {}
+        # {tag pk: tag fields values}
+        self.tags = {}
+        self.lock = threading.RLock()
+
+    def _tagmodel(self):
+        return self.cls._meta.get_field('tag').rel.to
+
+    def _key(self, pk):
+        "Returns the index key of a known tag."
+        model = self._tagmodel()
+        return self.tags[pk][model.taggable_fieldlist.index(
+            self.name)].lower()
+
+    def warm(self, fields):
+        """Loads the index of a scope with one :meth:`get_tags` query.
+
+        Returns the number of indexed tags.
+        """
+        model = self._tagmodel()
+        index = PrefixIndex(time.time() + self.ttl)
+        rows = []
+        for record in self.cls.get_tags(counts=True, lightweight=True,
+                                        **fields):
+            rows.append((tuple([getattr(record, name) for name in
+                                model.taggable_fieldlist]),
+                         record.count))
+        self.lock.acquire()
+        try:
+            pkindex = model.taggable_fieldlist.index(model._meta.pk.name)
+            for values, count in rows:
+                self.tags[values[pkindex]] = values
+            index.keys = sorted([(self._key(values[pkindex]),
+                                  values[pkindex]) for values, _ in rows])
+            index.counts = dict([(values[pkindex], count)
+                                 for values, count in rows])
+            self.indexes[scope_key(fields)] = index
+            if len(self.indexes) > self.scopes:
+                # drops the oldest index
+                oldest = min(self.indexes.items(),
+                             key=lambda item: item[1].expires)
+                del self.indexes[oldest[0]]
+        finally:
+            self.lock.release()
+        return len(rows)
+
+    def search(self, prefix, top, lightweight, fields):
+        """Returns the tags starting with ``prefix`` from a scope index.
+
+        Returns None when the scope wasn't warmed. Expired indexes are
+        reloaded first.
+        """
+        key = scope_key(fields)
+        index = self.indexes.get(key)
+        if index is None:
+            return None
+        if index.expires < time.time():
+            self.warm(fields)
+        self.lock.acquire()
+        try:
+            index = self.indexes.get(key)
+            if index is None:
+                return None
+            rows = [self.tags[pk] + (count, )
+                    for pk, count in index.search(prefix.lower(), top)]
+        finally:
+            self.lock.release()
+        return list(_build_tags(rows, self._tagmodel(), True, lightweight))
+
+    def changed(self, rows, sign):
+        """Updates the indexes with a list of added (``sign=1``) or removed
+        (``sign=-1``) tagged rows."""
+        self.lock.acquire()
+        try:
+            deltas = {}
+            for scope in self.indexes:
+                for row in rows:
+                    for field, value in scope:
+                        if row[field] != value:
+                            break
+                    else:
+                        delta = deltas.setdefault(scope, {})
+                        delta[row['tag']] = delta.get(row['tag'], 0) + sign
+            if sign > 0:
+                self._fetch(set([stats.field_value(tagpk)
+                                 for scopedelta in deltas.values()
+                                 for tagpk in scopedelta]))
+            for scope, delta in deltas.items():
+                index = self.indexes[scope]
+                for pk, count in delta.items():
+                    pk = stats.field_value(pk)
+                    if pk in self.tags:
+                        index.add(self._key(pk), pk, count)
+        finally:
+            self.lock.release()
+
+    def _fetch(self, pks):
+        "Reads the fields of the tags that aren't known yet."
+        model = self._tagmodel()
+        missing = [pk for pk in pks if pk not in self.tags]
+        pkindex = model.taggable_fieldlist.index(model._meta.pk.name)
+        for chunk in stats.chunked(missing):
+            for values in model.objects.filter(pk__in=chunk).values_list(
+                    *model.taggable_fieldlist):
+                self.tags[values[pkindex]] = values
+
+    def discard(self, tag):
+        "Removes a deleted tag from the indexes."
+        self.lock.acquire()
+        try:
+            if tag.pk not in self.tags:
+                return
+            key = self._key(tag.pk)
+            for index in self.indexes.values():
+                index.remove(key, tag.pk)
+            del self.tags[tag.pk]
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.indexes.clear()
+            self.tags.clear()
+        finally:
+            self.lock.release()
@@ -0,0 +1,328 @@
+"""Taggable benchmarks
+
+Measures the public tagging operations on generated data, see the
+``taggable_benchmark`` management command. The data is written with raw
+DELETE statements on the benchmarked tables, so always use a dedicated
+database (the command creates a test database).
+"""
+
+import math
+import random
+import sys
+import time
+
+import django
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction
+from django.db.models import AutoField, CharField, TextField
+from taggable import caching, planner, stats
+from taggable.instrumentation import Counter
+
+
+# default number of calls of every benchmarked operation
+REPEAT = 20
+
+# tags of every generated tagged entity
+TAGS_PER_ENTITY = 10
+
+# name prefix of the generated objects
+PREFIX = 'bench-'
+
+
+def default_models():
+    "Returns the tagged models of the test suite."
+    # imported here, taggable.tests imports this module
+    from taggable import tests
+    return [tests.SimpleTagged, tests.SimpleTaggedNoStats,
+            tests.ComplexTagged, tests.ComplexTaggedNoStats]
+
+
+class Dataset(object):
+    """Generated tagged rows of a tagged model.
+
+    ``fields`` are the sorted tagged fields besides ``tag``, ``entities``
+    tuples with primary keys for these fields, ``tags`` the primary keys of
+    the tags used by the rows and ``spare_tags`` of tags that are not used.
+    """
+
+    def __init__(self, cls, fields, entities, tags, spare_tags):
+        self.cls = cls
+        self.fields = fields
+        self.entities = entities
+        self.tags = tags
+        self.spare_tags = spare_tags
+
+
+def _related(cls, fieldname):
+    return cls._meta.get_field(fieldname).rel.to
+
+
+def name_field(model):
+    """Returns the text field used to name the generated objects of a model.
+
+    That's its first CharField or TextField. Returns None if there is none,
+    or if another field needs a value (not a text field, without a default
+    and not null), since the objects couldn't be generated.
+    """
+    name = None
+    for field in model._meta.local_fields:
+        if isinstance(field, AutoField):
+            continue
+        if isinstance(field, (CharField, TextField)):
+            name = name or field
+        elif not (field.null or field.has_default()):
+            return None
+    return name
+
+
+def check_model(cls):
+    "Raises ImproperlyConfigured if a tagged model can't be benchmarked."
+    for fieldname in sorted(cls.taggable_taggedfields):
+        model = _related(cls, fieldname)
+        if name_field(model) is None:
+            raise ImproperlyConfigured(
+                "%s can't be benchmarked: %s objects need a text field, "
+                "and defaults for their other fields" % (
+                    cls.__name__, model.__name__))
+
+
+def _create_objects(model, count, label):
+    "Inserts ``count`` named objects, returns their primary keys."
+    prefix = '%s%s-' % (PREFIX, label)
+    name = name_field(model).name
+    stats.bulk_insert(model, [model(**{name: '%s%d' % (prefix, i)})
+                              for i in xrange(count)])
+    return list(model.objects.filter(**{
+        '%s__startswith' % name: prefix}).order_by('pk').values_list(
+        'pk', flat=True))
+
+
+def pick_tags(rng, tags, count):
+    "Picks ``count`` distinct tags, the first tags being more frequent."
+    picked = set()
+    while len(picked) < count:
+        picked.add(tags[int(len(tags) * rng.random() ** 3)])
+    return picked
+
+
+def populate(cls, size, rng):
+    """Generates about ``size`` tagged rows with ``add_tags_bulk()``.
+
+    Every entity (combination of values of the fields besides ``tag``) gets
+    TAGS_PER_ENTITY tags. Returns a :class:`Dataset`.
+    """
+    fields = sorted(cls.taggable_taggedfields_notag)
+    nentities = max(1, size // TAGS_PER_ENTITY)
+    pool = int(math.ceil(nentities ** (1.0 / len(fields))))
+    values = dict([(field, _create_objects(_related(cls, field), pool,
+                                           field))
+                   for field in fields])
+    ntags = max(TAGS_PER_ENTITY * 2, int(math.sqrt(size) * 2))
+    tags = _create_objects(_related(cls, 'tag'), ntags * 2, 'tag')
+    entities = []
+    for i in xrange(nentities):
+        entity = []
+        for field in fields:
+            entity.append(values[field][i % pool])
+            i //= pool
+        entities.append(tuple(entity))
+
+    def rows():
+        for entity in entities:
+            for tag in pick_tags(rng, tags[:ntags], TAGS_PER_ENTITY):
+                row = dict(zip(fields, entity))
+                row['tag'] = tag
+                yield row
+    cls.add_tags_bulk(rows())
+    return Dataset(cls, fields, entities, tags[:ntags], tags[ntags:])
+
+
+def clear(cls):
+    "Deletes the tagged rows, stats and generated objects of a model."
+    qn = connection.ops.quote_name
+    backend = cls.taggable_count_cache
+    if backend is not None and not hasattr(backend, 'clear'):
+        # django 1.1 backends can't be cleared, only the counts of the
+        # deleted rows are removed
+        fieldnames = sorted(cls.taggable_taggedfields)
+        for chunk in stats.chunked(cls.objects.values_list(*fieldnames)):
+            caching.invalidate_rows(cls, [dict(zip(fieldnames, val))
+                                          for val in chunk])
+    cursor = connection.cursor()
+    tables = [cls] + cls.taggable_stats.values()
+    if cls.taggable_cooccurrence is not None:
+        tables.append(cls.taggable_cooccurrence)
+    for model in tables:
+        cursor.execute('DELETE FROM %s' % qn(model._meta.db_table))
+    for field in cls.taggable_taggedfields:
+        model = _related(cls, field)
+        cursor.execute('DELETE FROM %s WHERE %s LIKE %%s' % (
+            qn(model._meta.db_table), qn(name_field(model).column)),
+            [PREFIX + '%'])
+    transaction.commit_unless_managed()
+    if backend is not None and hasattr(backend, 'clear'):
+        backend.clear()
+    planner._estimates.clear()
+
+
+def _entity(data, rng):
+    return dict(zip(data.fields, rng.choice(data.entities)))
+
+
+def _add_tag(data, rng):
+    # add_tag() sets the foreign keys, so it needs model instances
+    fields = dict([(field, _related(data.cls, field)(pk=pk))
+                   for field, pk in _entity(data, rng).items()])
+    data.cls.add_tag(_related(data.cls, 'tag')(pk=rng.choice(
+        data.spare_tags)), **fields)
+
+
+def _update_tags(data, rng):
+    data.cls.update_tags(list(pick_tags(rng, data.tags, TAGS_PER_ENTITY)),
+                         **_entity(data, rng))
+
+
+def _tag_count(data, rng):
+    data.cls.tag_count(tag=rng.choice(data.tags))
+
+
+def _tag_count_field(data, rng):
+    field = data.fields[0]
+    data.cls.tag_count(**{field: _entity(data, rng)[field]})
+
+
+def _tag_counts(data, rng):
+    data.cls.tag_counts([{'tag': tag} for tag in data.tags[:50]])
+
+
+def _get_tags(data, rng):
+    list(data.cls.get_tags(counts=True))
+
+
+def _get_tags_top(data, rng):
+    list(data.cls.get_tags(top=20))
+
+
+def _get_tags_field(data, rng):
+    field = data.fields[0]
+    list(data.cls.get_tags(counts=True,
+                           **{field: _entity(data, rng)[field]}))
+
+
+def _queryset_get_tags(data, rng):
+    list(data.cls.objects.filter(**_entity(data, rng)).get_tags(
+        counts=True))
+
+
+def _tagged_with_all(data, rng):
+    list(data.cls.objects.all().tagged_with_all(rng.sample(data.tags, 2),
+                                                data.fields[-1]))
+
+
+def _related_tags(data, rng):
+    list(data.cls.related_tags(rng.choice(data.tags), top=10))
+
+
+def _delete(data, rng):
+    data.cls.objects.filter(**_entity(data, rng)).delete()
+
+
+# the benchmarked operations, in execution order
+OPERATIONS = (
+    ('add_tag', _add_tag),
+    ('update_tags', _update_tags),
+    ('tag_count', _tag_count),
+    ('tag_count_field', _tag_count_field),
+    ('tag_counts', _tag_counts),
+    ('get_tags', _get_tags),
+    ('get_tags_top', _get_tags_top),
+    ('get_tags_field', _get_tags_field),
+    ('queryset_get_tags', _queryset_get_tags),
+    ('tagged_with_all', _tagged_with_all),
+    ('related_tags', _related_tags),
+    ('queryset_delete', _delete),
+)
+
+
+def measure(cls, size, operation, func, calls):
+    "Calls ``func`` ``calls`` times and returns a result dict."
+    counter = Counter()
+    counter.start()
+    try:
+        start = time.time()
+        for _ in xrange(calls):
+            func()
+        seconds = time.time() - start
+    finally:
+        counter.stop()
+    return {'model': '%s.%s' % (cls._meta.app_label,
+                                cls._meta.object_name),
+            'size': size,
+            'operation': operation,
+            'calls': calls,
+            'seconds': seconds,
+            'mean': seconds / calls,
+            'queries': float(counter.queries) / calls,
+            'rows': float(counter.rows) / calls}
+
+
+def run(models, sizes, repeat=REPEAT, seed=0, callback=None):
+    """Benchmarks tagged models at several data sizes.
+
+    For every model and size, the data is generated (measured as the
+    ``add_tags_bulk`` operation), every operation of OPERATIONS is called
+    ``repeat`` times, and the data is deleted.
+    Returns a list of result dicts, that are also passed to ``callback``.
+    Raises ImproperlyConfigured for models that can't be benchmarked, see
+    :func:`check_model`.
+    """
+    for cls in models:
+        check_model(cls)
+    results = []
+
+    def add(result):
+        results.append(result)
+        if callback is not None:
+            callback(result)
+
+    for cls in models:
+        for size in sizes:
+            rng = random.Random(seed)
+            clear(cls)
+            datasets = []
+            add(measure(cls, size, 'add_tags_bulk',
+                        lambda: datasets.append(populate(cls, size, rng)),
+                        1))
+            data = datasets[0]
+            for operation, func in OPERATIONS:
+                add(measure(cls, size, operation,
+                            lambda: func(data, rng), repeat))
+            clear(cls)
+    return results
+
+
+def report(results):
+    "Returns a JSON serializable report with the results and environment."
+    return {'python': sys.version.split()[0],
+            'django': django.get_version(),
+            'database': stats.vendor(),
+            'results': results}
+
+
+def compare(old, new):
+    """Compares two reports.
+
+    Returns a list of ``(model, size, operation, old mean, new mean,
+    old queries, new queries)`` for the results found in both reports.
+    """
+    oldresults = dict([((r['model'], r['size'], r['operation']), r)
+                       for r in old['results']])
+    comparison = []
+    for result in new['results']:
+        key = (result['model'], result['size'], result['operation'])
+        if key in oldresults:
+            comparison.append(key + (oldresults[key]['mean'],
+                                     result['mean'],
+                                     oldresults[key]['queries'],
+                                     result['queries']))
+    return comparison
@@ -0,0 +1,85 @@
+"Taggable tag_count cache"
+
+from django.core import cache as django_cache
+
+from taggable import stats
+
+
+def get_backend(config):
+    """Returns the cache backend for a ``Taggable.count_cache`` value.
+
+    ``True`` uses the default django cache, a string is a cache backend URI,
+    and anything else is used as a cache backend object.
+    """
+    if not config:
+        return None
+    if config is True:
+        return django_cache.cache
+    if isinstance(config, basestring):
+        return django_cache.get_cache(config)
+    return config
+
+
+def count_key(cls, fields):
+    "Returns the cache key for a tag_count() call."
+    return 'taggable:%s.%s:%s' % (
+        cls._meta.app_label, cls._meta.object_name,
+        ':'.join(['%s=%s' % (field, stats.field_value(fields[field]))
+                  for field in sorted(fields)]))
+
+
+def _subsets(fieldnames):
+    "Returns all the subsets of a list of field names."
+    subsets = [()]
+    for field in fieldnames:
+        subsets += [subset + (field, ) for subset in subsets]
+    return subsets
+
+
+def invalidate_keys(cls, keys, keyvals):
+    """Removes the cached counts of a list of key values of a set of fields.
+
+    The counts of the subsets of ``keys`` are summed from these keys, so
+    they're removed too.
+    """
+    for chunk in stats.chunked(keyvals):
+        invalidate_rows(cls, [dict(zip(keys, val)) for val in chunk], keys)
+
+
+def invalidate_rows(cls, rows, fieldnames=None):
+    """Removes the cached counts affected by a list of tagged rows.
+
+    A tagged row changes the count of every combination of its fields
+    (or of ``fieldnames``).
+    """
+    if fieldnames is None:
+        fieldnames = cls.taggable_taggedfields
+    subsets = _subsets(sorted(fieldnames))
+    cachekeys = set()
+    for row in rows:
+        for subset in subsets:
+            cachekeys.add(count_key(cls, dict([(field, row[field])
+                                                for field in subset])))
+    for chunk in stats.chunked(cachekeys):
+        _delete_many(cls.taggable_count_cache, chunk)
+
+
+def _delete_many(backend, cachekeys):
+    try:
+        # django 1.2+
+        backend.delete_many(cachekeys)
+    except AttributeError:
+        # django 1.1
+        for cachekey in cachekeys:
+            backend.delete(cachekey)
+
+
+def set_many(backend, data, timeout=None):
+    "Caches a dict of values, also on django 1.1 backends."
+    try:
+        # django 1.2+
+        backend.set_many(data, timeout)
+    except AttributeError:
+        # django 1.1
+        for cachekey, value in data.items():
+            backend.set(cachekey, value, timeout)
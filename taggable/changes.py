@@ -0,0 +1,100 @@
+"Propagation of tagged rows changes to the stats tables and caches"
+
+from taggable import caching, cooccurrence, stats, taglist
+
+
+def _needs_rows(cls):
+    "Returns True if the changes of a tagged model need the removed rows."
+    return (cls.taggable_count_cache is not None or
+            cls.taggable_cooccurrence is not None or
+            cls.taggable_tag_list is not None or
+            bool(cls.taggable_autocomplete.indexes))
+
+
+def added(cls, rows, using=None):
+    """Called after adding a list of tagged rows.
+
+    ``rows`` are dicts of tagged field names and raw values, ``using`` the
+    database alias of the rows (None for the routers' choice).
+    """
+    stats.update_stats(cls, stats.stats_deltas(cls, rows, 1), using)
+    if cls.taggable_count_cache is not None:
+        caching.invalidate_rows(cls, rows)
+    if cls.taggable_cooccurrence is not None:
+        cooccurrence.added(cls, rows, using)
+    if cls.taggable_tag_list is not None:
+        taglist.rows_changed(cls, rows, using)
+    if cls.taggable_autocomplete.indexes:
+        cls.taggable_autocomplete.changed(rows, 1)
+
+
+def removing(qset, exclude=()):
+    """Called before deleting a tagged queryset.
+
+    The stats tables with the ``exclude`` keys are not updated.
+    Returns the changes that will be passed to :func:`removed`.
+    """
+    # the database the queryset deletes from, if not routed
+    changes = {'deltas': stats.queryset_deltas(qset, exclude=exclude),
+               'using': getattr(qset, '_db', None)}
+    if _needs_rows(qset.model):
+        fieldnames = sorted(qset.model.taggable_taggedfields)
+        changes['rows'] = [dict(zip(fieldnames, val)) for val in
+                           qset.values_list(*fieldnames).order_by()]
+    return changes
+
+
+def removed(cls, changes):
+    "Called after deleting a tagged queryset."
+    using = changes['using']
+    stats.update_stats(cls, changes['deltas'], using)
+    if cls.taggable_count_cache is not None:
+        caching.invalidate_rows(cls, changes['rows'])
+    if cls.taggable_cooccurrence is not None:
+        cooccurrence.removed(cls, changes['rows'], using)
+    if cls.taggable_tag_list is not None:
+        taglist.rows_changed(cls, changes['rows'], using)
+    if cls.taggable_autocomplete.indexes:
+        if 'rows' in changes:
+            cls.taggable_autocomplete.changed(changes['rows'], -1)
+        else:
+            # warmed while deleting, the removed rows are unknown
+            cls.taggable_autocomplete.clear()
+
+
+def purge(cls, fieldname, value, chunk_size=stats.CHUNK_SIZE, using=None):
+    """Deletes the tagged rows of an object, in chunks.
+
+    The rows of the stats tables keyed on ``fieldname`` are dropped with a
+    single statement instead of being decremented. The tagged rows are
+    deleted by primary key in chunks of ``chunk_size``, without loading
+    them, and the other stats tables are decremented with the grouped
+    deltas of every chunk. Every chunk is committed, unless transactions
+    are managed. ``using`` is the database alias of the tagged rows.
+    Returns the number of deleted tagged rows.
+    """
+    value = stats.field_value(value)
+    if cls.taggable_stats_buffer is not None:
+        # the buffered deltas could recreate the dropped stats rows
+        cls.taggable_stats_buffer.flush()
+    keyed = [keys for keys in cls.taggable_stats if fieldname in keys]
+    for keys in keyed:
+        statsmodel = cls.taggable_stats[keys]
+        statsdb = stats.db_for_write(statsmodel, using)
+        stats.raw_delete(statsmodel, fieldname, [value], statsdb)
+        stats.commit_unless_managed(statsdb)
+    using = stats.db_for_write(cls, using)
+    pkname = cls._meta.pk.name
+    manager = stats.get_manager(cls, using)
+    qset = manager.filter(**{fieldname: value}).order_by(pkname)
+    deleted = 0
+    while True:
+        pks = list(qset.values_list(pkname, flat=True)[:chunk_size])
+        if not pks:
+            break
+        chunk_changes = removing(manager.filter(pk__in=pks), keyed)
+        stats.raw_delete(cls, pkname, pks, using)
+        removed(cls, chunk_changes)
+        stats.commit_unless_managed(using)
+        deleted += len(pks)
+    return deleted
@@ -0,0 +1,123 @@
+"Taggable tag co-occurrence tables"
+
+from taggable import stats
+
+
+# fields of a co-occurrence model
+KEYS = ('tag_a', 'tag_b')
+
+
+def _entity_fields(cls):
+    "Returns the fields that identify a tagged entity (all but the tag)."
+    return sorted(cls.taggable_taggedfields_notag)
+
+
+def _by_entity(cls, rows):
+    "Returns a dict with the set of tags of every entity in a list of rows."
+    entityfields = _entity_fields(cls)
+    changed = {}
+    for row in rows:
+        entity = tuple([row[field] for field in entityfields])
+        changed.setdefault(entity, set()).add(row['tag'])
+    return changed
+
+
+def _entity_tags(cls, entities, using=None):
+    "Returns a dict with the current set of tags of a list of entities."
+    entityfields = _entity_fields(cls)
+    tags = dict([(entity, set()) for entity in entities])
+    for chunk in stats.chunked(tags.keys()):
+        qset = stats.get_manager(cls, using).filter(
+            stats.keys_q(entityfields, chunk))
+        for row in qset.values_list(*entityfields + ['tag']):
+            tags[tuple(row[:-1])].add(row[-1])
+    return tags
+
+
+def _pair_deltas(changed, tags, sign):
+    """Returns the co-occurrence deltas of tags added to/removed from entities.
+
+    Every ordered pair of tags of an entity where at least one of the tags
+    changed gets ``sign``.
+    """
+    deltas = {}
+    for entity, ctags in changed.items():
+        alltags = tags[entity] | ctags
+        for tag_a in ctags:
+            for tag_b in alltags:
+                if tag_a == tag_b:
+                    continue
+                deltas[(tag_a, tag_b)] = deltas.get((tag_a, tag_b), 0) + sign
+                if tag_b not in ctags:
+                    deltas[(tag_b, tag_a)] = deltas.get((tag_b, tag_a),
+                                                        0) + sign
+    return deltas
+
+
+def added(cls, rows, using=None):
+    "Updates the co-occurrence table after adding a list of tagged rows."
+    changed = _by_entity(cls, rows)
+    stats.apply_deltas(cls.taggable_cooccurrence, KEYS,
+        _pair_deltas(changed, _entity_tags(cls, changed.keys(), using), 1),
+        using)
+
+
+def removed(cls, rows, using=None):
+    "Updates the co-occurrence table after removing a list of tagged rows."
+    changed = _by_entity(cls, rows)
+    stats.apply_deltas(cls.taggable_cooccurrence, KEYS,
+        _pair_deltas(changed, _entity_tags(cls, changed.keys(), using), -1),
+        using)
+
+
+def _join_sql(cls, conn, where=''):
+    "Returns a self join of the tagged table that counts pairs of tags."
+    qn = conn.ops.quote_name
+    opts = cls._meta
+    tag = qn(opts.get_field('tag').column)
+    on = ' AND '.join(['a.%s = b.%s' % ((qn(opts.get_field(field).column), )
+                                        * 2)
+                       for field in _entity_fields(cls)])
+    return ('SELECT a.%(tag)s, b.%(tag)s, COUNT(*) '
+            'FROM %(table)s a INNER JOIN %(table)s b '
+            'ON (%(on)s AND a.%(tag)s <> b.%(tag)s) %(where)s'
+            'GROUP BY a.%(tag)s, b.%(tag)s') % {
+        'tag': tag, 'table': qn(opts.db_table), 'on': on, 'where': where}
+
+
+def related_counts(cls, tagpk, top=None):
+    """Computes the tags used with a tag, without a co-occurrence table.
+
+    Returns a list of (tag pk, count), sorted by count.
+    """
+    conn = stats.get_connection(stats.db_for_read(cls))
+    qn = conn.ops.quote_name
+    sql = _join_sql(cls, conn, 'WHERE a.%s = %%s ' % qn(
+        cls._meta.get_field('tag').column))
+    sql += ' ORDER BY 3 DESC, 2'
+    if top:
+        sql += ' LIMIT %d' % int(top)
+    cursor = conn.cursor()
+    cursor.execute(sql, [tagpk])
+    return [(row[1], row[2]) for row in cursor.fetchall()]
+
+
+def rebuild(cls):
+    "Recomputes the co-occurrence table of a tagged model."
+    using = stats.db_for_write(cls.taggable_cooccurrence)
+    stats.commit_on_success(using, _rebuild, cls, using)
+
+
+def _rebuild(cls, using):
+    coocmodel = cls.taggable_cooccurrence
+    stats.get_manager(coocmodel, using).all().delete()
+    conn = stats.get_connection(stats.db_for_read(cls))
+    cursor = conn.cursor()
+    cursor.execute(_join_sql(cls, conn))
+    while True:
+        rows = cursor.fetchmany(stats.CHUNK_SIZE)
+        if not rows:
+            break
+        stats.bulk_insert(coocmodel, [
+            coocmodel(tag_a_id=tag_a, tag_b_id=tag_b, count=count)
+            for tag_a, tag_b, count in rows], using)
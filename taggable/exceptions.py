@@ -4,3 +4,8 @@
 class InvalidFields(Exception):
     "Raised when passing an invalid/nonexistant field for an object"
     pass
+
+
+class InvalidCursor(Exception):
+    "Raised when passing an invalid pagination cursor"
+    pass
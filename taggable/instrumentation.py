@@ -0,0 +1,252 @@
+"""Taggable instrumentation
+
+The ``tagged_operation`` signal is sent after every instrumented tagging
+operation, with these arguments:
+
+``sender``
+    The tagged model.
+``operation``
+    The name of the operation: ``add_tag``, ``update_tags``,
+    ``tag_count``, ``get_tagged_fields``, ``iter_tagged_fields``,
+    ``autocomplete``, ``save`` or ``delete``.
+``plan``
+    The :class:`taggable.planner.Plan` used to read the counts, or None
+    when the operation didn't choose one.
+``queries``
+    The number of SQL statements executed.
+``seconds``
+    The elapsed time.
+``rows``
+    The number of tagged rows written, or of results read, when known.
+
+Nothing is measured when the signal has no receivers.
+"""
+
+import functools
+import threading
+import time
+import types
+
+from django.db import connection, models
+try:
+    # django 1.2+
+    from django.db import connections
+except ImportError:
+    # django 1.1
+    connections = None
+from django.dispatch import Signal
+
+
+tagged_operation = Signal(providing_args=['operation', 'plan', 'queries',
+                                          'seconds', 'rows'])
+
+# the measures of the running operations
+_local = threading.local()
+
+
+class CountingCursor(object):
+    "Cursor wrapper that counts the executed statements and fetched rows."
+
+    def __init__(self, cursor, counter):
+        self.cursor = cursor
+        self.counter = counter
+
+    def execute(self, *args):
+        self.counter.queries += 1
+        return self.cursor.execute(*args)
+
+    def executemany(self, *args):
+        self.counter.queries += 1
+        return self.cursor.executemany(*args)
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            self.counter.rows += 1
+        return row
+
+    def fetchmany(self, *args):
+        rows = self.cursor.fetchmany(*args)
+        self.counter.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        self.counter.rows += len(rows)
+        return rows
+
+    def __iter__(self):
+        for row in self.cursor:
+            self.counter.rows += 1
+            yield row
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+
+class Counter(object):
+    """Counts the statements executed and the rows fetched.
+
+    Between :meth:`start` and :meth:`stop`, the cursors of every
+    connection (that are thread local) are wrapped with
+    :class:`CountingCursor`. Counters can be nested.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.rows = 0
+        # [(connection, previous cursor attribute)]
+        self.previous = []
+
+    def start(self):
+        if connections is None:
+            conns = [connection]
+        else:
+            conns = connections.all()
+        self.previous = [(conn, conn.__dict__.get('cursor'))
+                         for conn in conns]
+        for conn, _ in self.previous:
+            self._wrap(conn)
+
+    def _wrap(self, conn):
+        cursor = conn.cursor
+        conn.cursor = lambda: CountingCursor(cursor(), self)
+
+    def stop(self):
+        for conn, previous in self.previous:
+            if previous is None:
+                del conn.cursor
+            else:
+                conn.cursor = previous
+        self.previous = []
+
+
+class Measure(object):
+    "The statements, time, plan and rows of a running operation."
+
+    def __init__(self, sender, operation):
+        self.sender = sender
+        self.operation = operation
+        self.plan = None
+        self.rows = None
+        self.seconds = 0.0
+        self.counter = Counter()
+        self.started = None
+
+    def start(self):
+        _stack().append(self)
+        self.counter.start()
+        self.started = time.time()
+
+    def stop(self):
+        self.seconds += time.time() - self.started
+        self.counter.stop()
+        _stack().pop()
+
+    def send(self):
+        tagged_operation.send(sender=self.sender,
+                              operation=self.operation,
+                              plan=self.plan,
+                              queries=self.counter.queries,
+                              seconds=self.seconds,
+                              rows=self.rows)
+
+
+def _stack():
+    try:
+        return _local.stack
+    except AttributeError:
+        _local.stack = []
+        return _local.stack
+
+
+def measuring():
+    "Returns True when an operation is being measured."
+    return bool(getattr(_local, 'stack', None))
+
+
+def unmeasured(func, *args):
+    """Calls a function, leaving its statements and time out of the
+    running measures."""
+    stack = getattr(_local, 'stack', None) or []
+    saved = [(measure.counter.queries, measure.counter.rows)
+             for measure in stack]
+    started = time.time()
+    try:
+        return func(*args)
+    finally:
+        elapsed = time.time() - started
+        for measure, (queries, rows) in zip(stack, saved):
+            measure.counter.queries, measure.counter.rows = queries, rows
+            measure.started += elapsed
+
+
+def note(plan=None, rows=None):
+    "Sets the plan and/or rows of the running operation, if measured."
+    stack = getattr(_local, 'stack', None)
+    if not stack:
+        return
+    if plan is not None:
+        stack[-1].plan = plan
+    if rows is not None:
+        stack[-1].rows = rows
+
+
+def _sender(obj):
+    "Returns the tagged model of a model, instance or queryset."
+    if isinstance(obj, models.query.QuerySet):
+        return obj.model
+    if isinstance(obj, type):
+        return obj
+    return type(obj)
+
+
+def _iterate(measure, iterator):
+    "Measures the iteration of a lazy result, sends the signal at the end."
+    rows = 0
+    while True:
+        measure.start()
+        try:
+            try:
+                item = iterator.next()
+            except StopIteration:
+                break
+        finally:
+            measure.stop()
+        rows += 1
+        yield item
+    if measure.rows is None:
+        measure.rows = rows
+    measure.send()
+
+
+def instrumented(operation):
+    """Decorator that sends ``tagged_operation`` after a method call.
+
+    The first argument of the method is a tagged model, instance or
+    queryset. Generators are measured while they are iterated, and the
+    signal is sent when they are exhausted. Calls made by an operation of
+    the same name (e.g. a fallback to the queryset) are not sent twice.
+    """
+
+    def decorator(f):
+
+        @functools.wraps(f)
+        def _instrumented(obj, *args, **kwargs):
+            if not tagged_operation.receivers:
+                return f(obj, *args, **kwargs)
+            stack = _stack()
+            if stack and stack[-1].operation == operation:
+                return f(obj, *args, **kwargs)
+            measure = Measure(_sender(obj), operation)
+            measure.start()
+            try:
+                result = f(obj, *args, **kwargs)
+            finally:
+                measure.stop()
+            if isinstance(result, types.GeneratorType):
+                return _iterate(measure, result)
+            measure.send()
+            return result
+        return _instrumented
+    return decorator
@@ -0,0 +1,89 @@
+"Management command that benchmarks the tagging operations"
+
+import sys
+from optparse import make_option
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import simplejson
+from taggable import benchmarks
+from taggable.management.commands.taggable_rebuild_stats import \
+    tagged_models
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--sizes', dest='sizes', default='1000,10000',
+                    help='Comma separated numbers of tagged rows.'),
+        make_option('--repeat', dest='repeat', type='int',
+                    default=benchmarks.REPEAT,
+                    help='Number of calls of every operation.'),
+        make_option('--seed', dest='seed', type='int', default=0,
+                    help='Seed of the generated data.'),
+        make_option('--output', dest='output', default=None,
+                    help='Write the JSON results to a file instead of '
+                         'the standard output.'),
+        make_option('--compare', dest='compare', default=None,
+                    help='Compare the results with a previous JSON file.'),
+        make_option('--noinput', action='store_false', dest='interactive',
+                    default=True,
+                    help='Do NOT prompt the user for input of any kind.'),
+    )
+    help = ('Benchmarks the tagging operations on the test models, in a '
+            'test database. Use --settings to run it on another database '
+            '(e.g. PostgreSQL).')
+    args = '[appname.ModelName ...]'
+
+    def handle(self, *labels, **options):
+        verbosity = int(options.get('verbosity', 1))
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError('Invalid sizes: %s' % options['sizes'])
+        old = None
+        if options['compare']:
+            old = simplejson.load(open(options['compare']))
+        models = benchmarks.default_models()
+        if labels:
+            models = tagged_models(labels)
+        for model in models:
+            try:
+                benchmarks.check_model(model)
+            except ImproperlyConfigured, e:
+                raise CommandError(str(e))
+
+        def progress(result):
+            if verbosity:
+                sys.stderr.write('%(model)s %(size)d %(operation)s: '
+                                 '%(mean).5fs %(queries).1f queries '
+                                 '%(rows).1f rows\n' % result)
+
+        try:
+            # django 1.2+
+            old_name = connection.settings_dict['NAME']
+        except KeyError:
+            # django 1.1
+            old_name = connection.settings_dict['DATABASE_NAME']
+        connection.creation.create_test_db(max(verbosity - 1, 0),
+            autoclobber=not options['interactive'])
+        try:
+            report = benchmarks.report(benchmarks.run(models, sizes,
+                options['repeat'], options['seed'], progress))
+        finally:
+            connection.creation.destroy_test_db(old_name,
+                                                max(verbosity - 1, 0))
+
+        if options['output']:
+            output = open(options['output'], 'w')
+            simplejson.dump(report, output, indent=2)
+            output.close()
+        else:
+            print simplejson.dumps(report, indent=2)
+        if old is not None:
+            for (model, size, operation, oldmean, newmean, oldqueries,
+                 newqueries) in benchmarks.compare(old, report):
+                sys.stderr.write('%s %d %s: %.2fx time, %.1f -> %.1f '
+                                 'queries\n' % (model, size, operation,
+                                 newmean / (oldmean or 1e-9), oldqueries,
+                                 newqueries))
@@ -0,0 +1,70 @@
+"Management command that rebuilds the stats tables of tagged models"
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models
+from taggable.models import Tagged
+
+
+def tagged_models(labels, default=lambda model: model.taggable_stats):
+    """Returns the tagged models for a list of model labels.
+
+    Without labels, returns the tagged models for which ``default`` is true
+    (by default, the models with stats tables).
+    """
+    if not labels:
+        return [model for model in models.get_models()
+                if issubclass(model, Tagged) and default(model)]
+    results = []
+    for label in labels:
+        try:
+            app_label, model_name = label.split('.')
+        except ValueError:
+            raise CommandError('Invalid model label: %s' % label)
+        model = models.get_model(app_label, model_name)
+        if model is None or not issubclass(model, Tagged):
+            raise CommandError('Unknown tagged model: %s' % label)
+        results.append(model)
+    return results
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False,
+                    help='Only report the wrong keys, without writing.'),
+        make_option('--compact', action='store_true', dest='compact',
+                    default=False,
+                    help='Fold the shards of sharded stats tables instead '
+                         'of rebuilding.'),
+    )
+    help = ('Recomputes the stats tables of tagged models from the tagged '
+            'tables.')
+    args = '[appname.ModelName ...]'
+
+    def handle(self, *labels, **options):
+        dry_run = options.get('dry_run', False)
+        verbosity = int(options.get('verbosity', 1))
+
+        def report(statsmodel, val, expected, stored):
+            if dry_run or verbosity > 1:
+                print '%s %r: expected %d, found %d' % (
+                    statsmodel._meta.object_name, val, expected, stored)
+
+        for model in tagged_models(labels):
+            if options.get('compact', False):
+                for keys, folded in model.compact_stats().items():
+                    statsmodel = model.taggable_stats[keys]
+                    if verbosity and statsmodel.taggable_shards:
+                        print '%s.%s %s: %d folded rows' % (
+                            model._meta.app_label, model._meta.object_name,
+                            statsmodel._meta.object_name, folded)
+                continue
+            results = model.rebuild_stats(dry_run=dry_run, callback=report)
+            for keys, wrong in results.items():
+                if verbosity:
+                    print '%s.%s %s: %d wrong keys%s' % (
+                        model._meta.app_label, model._meta.object_name,
+                        model.taggable_stats[keys]._meta.object_name,
+                        wrong, ' (dry run)' if dry_run and wrong else '')
@@ -0,0 +1,31 @@
+"Management command that rebuilds the tag lists of tagged models"
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from taggable import stats
+from taggable.management.commands.taggable_rebuild_stats import \
+    tagged_models
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int',
+                    default=stats.CHUNK_SIZE,
+                    help='Number of objects rewritten per query.'),
+    )
+    help = ('Rewrites the Taggable.tag_list fields of tagged models from '
+            'the tagged tables.')
+    args = '[appname.ModelName ...]'
+
+    def handle(self, *labels, **options):
+        verbosity = int(options.get('verbosity', 1))
+        for model in tagged_models(labels,
+                                   lambda model: model.taggable_tag_list):
+            if model.taggable_tag_list is None:
+                raise CommandError('%s.%s has no Taggable.tag_list' % (
+                    model._meta.app_label, model._meta.object_name))
+            total = model.rebuild_tag_lists(options['chunk_size'])
+            if verbosity:
+                print '%s.%s: %d objects' % (model._meta.app_label,
+                                             model._meta.object_name, total)
@@ -21,3 +21,8 @@ class TaggedManager(models.Manager):
 
     def get_query_set(self):
         return TaggedQuerySet(self.model, **self._kwargs())
+
+    def prefetch_tags(self, objects, fieldname, attr='tags', qfilter=None,
+                      lightweight=False):
+        return self.get_query_set().prefetch_tags(objects, fieldname, attr,
+                                                  qfilter, lightweight)
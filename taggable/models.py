@@ -1,9 +1,15 @@
 "Taggable models"
 
+from django.core.exceptions import ImproperlyConfigured
 from django.db import models
+from django.db.models import Sum
 from taggable.managers import TaggedManager
-from taggable.querysets import queryset_filter_with_counts
+from taggable.querysets import queryset_count_page, \
+    queryset_filter_with_counts, queryset_iter_with_counts, tag_values
 from taggable.exceptions import InvalidFields
+from taggable import caching, changes, cooccurrence, planner, stats, \
+    taglist
+from taggable.instrumentation import instrumented, note
 
 
 class Tagged(models.Model):
@@ -16,97 +22,487 @@ class Tagged(models.Model):
             results.append((field, val))
         return results
 
+    @instrumented('save')
     def save(self, *args, **kwargs):
         "Saves the tagged object and handles the stats table maintenance."
         super(Tagged, self).save(*args, **kwargs)
+        changes.added(type(self), [stats.tagged_row(self)],
+                      stats.instance_db(self))
+        note(rows=1)
 
-        for fields, statsmodel in self.taggable_stats.items():
-            qdict = dict(self.taggable_get_fields(fields))
-            qset = statsmodel.objects.filter(**qdict)
-            updated_rows = qset.update(count=models.F('count') + 1)
-            if updated_rows == 0:
-                # 0 rows updated, this means we need to create a stats entry
-                qdict['count'] = 1
-                statsmodel(**qdict).save(force_insert=True)
+    @classmethod
+    def flush_stats(cls):
+        "Writes the buffered stats deltas when using deferred stats."
+        if cls.taggable_stats_buffer is not None:
+            cls.taggable_stats_buffer.flush()
+
+    @classmethod
+    def rebuild_stats(cls, dry_run=False, callback=None,
+                      chunk_size=stats.CHUNK_SIZE):
+        """Recomputes all the stats tables from the tagged table.
+
+        Streams one GROUP BY query per stats table, in chunks of
+        ``chunk_size`` keys. With ``dry_run`` the wrong keys are only
+        reported to ``callback``, see :func:`taggable.stats.rebuild_stats`.
+        Returns a dict with the number of wrong keys of every stats table.
+        """
+        cls.flush_stats()
+        return dict([(keys, stats.rebuild_stats(cls, keys, dry_run, callback,
+                                                chunk_size))
+                     for keys in cls.taggable_stats])
+
+    @classmethod
+    def compact_stats(cls):
+        """Folds the shards of the sharded stats tables.
+
+        See :func:`taggable.stats.compact_stats`, returns a dict with the
+        number of folded rows of every stats table.
+        """
+        cls.flush_stats()
+        return dict([(keys, stats.compact_stats(cls, keys))
+                     for keys in cls.taggable_stats])
+
+    @classmethod
+    def _check_tag_list(cls):
+        if cls.taggable_tag_list is None:
+            raise ImproperlyConfigured('%s has no Taggable.tag_list'
+                                       % cls.__name__)
 
     @classmethod
+    def tag_list(cls, obj):
+        "Returns the tag names stored in the ``Taggable.tag_list`` field."
+        cls._check_tag_list()
+        return taglist.loads(getattr(obj, cls.taggable_tag_list[1]))
+
+    @classmethod
+    def rebuild_tag_lists(cls, chunk_size=stats.CHUNK_SIZE):
+        """Rewrites the ``Taggable.tag_list`` field of all the objects.
+
+        Needed for existing data and after renaming tags, see
+        :func:`taggable.taglist.rebuild`. Returns the number of objects.
+        """
+        cls._check_tag_list()
+        return taglist.rebuild(cls, chunk_size)
+
+    @classmethod
+    def related_tags(cls, tag, top=None, lightweight=False):
+        """Returns the tags used together with a tag, with counts.
+
+        The count of a related tag is the number of tagged entities (values
+        of the tagged fields besides ``tag``) that have both tags. Reads the
+        ``Taggable.cooccurrence`` table with one indexed query, or computes
+        the counts with a self join when there is none.
+        Sorted by count, ``top`` limits the number of results.
+        """
+        model = cls._meta.get_field('tag').rel.to
+        tagpk = stats.field_value(tag)
+        if cls.taggable_cooccurrence is not None:
+            qset = cls.taggable_cooccurrence.objects.filter(
+                tag_a=tagpk).select_related('tag_b').values_list(
+                *tag_values('tag_b', model) + ['count']).order_by(
+                '-count', 'tag_b__%s' % model._meta.pk.name)
+            return queryset_filter_with_counts(qset, 'tag_b', None, model,
+                                               True, lightweight, top)
+        counts = cooccurrence.related_counts(cls, tagpk, top)
+        pkindex = model.taggable_fieldlist.index(model._meta.pk.name)
+        tags = dict([(row[pkindex], row) for row in model.objects.filter(
+            pk__in=[pk for pk, _ in counts]).values_list(
+            *model.taggable_fieldlist)])
+        return queryset_filter_with_counts(
+            [tags[pk] + (count, ) for pk, count in counts], 'tag', None,
+            model, True, lightweight)
+
+    @classmethod
+    def rebuild_cooccurrence(cls):
+        "Recomputes the ``Taggable.cooccurrence`` table."
+        if cls.taggable_cooccurrence is not None:
+            cooccurrence.rebuild(cls)
+
+    @classmethod
+    @instrumented('tag_count')
     def tag_count(cls, **fields):
-        key = tuple(sorted(fields.keys()))
-        if key in cls.taggable_stats:
-            model = cls.taggable_stats[key]
-            try:
-                return model.objects.get(**fields).count
-            except model.DoesNotExist:
-                return 0
-        return cls.objects.filter(**fields).count()
+        backend = cls.taggable_count_cache
+        if backend is None:
+            return cls._tag_count(**fields)
+        cachekey = caching.count_key(cls, fields)
+        count = backend.get(cachekey)
+        if count is None:
+            count = cls._tag_count(**fields)
+            backend.set(cachekey, count, cls.taggable_count_cache_timeout)
+        return count
+
+    @classmethod
+    def _tag_count(cls, **fields):
+        return planner.tag_count(cls, fields)
+
+    @classmethod
+    def explain(cls, fieldname=None, counts=True, qfilter=None, **fields):
+        """Returns the :class:`taggable.planner.Plan` used by a query.
+
+        With a ``fieldname`` it's the plan of ``get_tagged_fields()``,
+        otherwise the plan of ``tag_count()``.
+        """
+        return planner.plan(cls, fields, fieldname,
+                            aggregate=not (counts and qfilter))
+
+    @classmethod
+    def tag_counts(cls, fieldslist):
+        """Returns the tag counts of a list of field dicts.
+
+        The dicts are grouped by field names, and every group is counted
+        with a single query (on the matching stats table, if any).
+        Returns a dict with ``tuple(sorted(fields.items()))`` of every field
+        dict as keys, and the counts as values.
+        """
+        groups = {}
+        for fields in fieldslist:
+            cls._check_fields(allfields=False, includetag=True, **fields)
+            keys = tuple(sorted(fields.keys()))
+            groups.setdefault(keys, []).append(
+                (tuple(sorted(fields.items())),
+                 tuple([stats.field_value(fields[key]) for key in keys])))
+        results = {}
+        backend = cls.taggable_count_cache
+        for keys, items in groups.items():
+            keyvals = set([val for _, val in items])
+            counts = {}
+            if backend is not None:
+                cachekeys = dict([
+                    (caching.count_key(cls, dict(zip(keys, val))), val)
+                    for val in keyvals])
+                counts = dict([(cachekeys[cachekey], count) for
+                               cachekey, count in
+                               backend.get_many(cachekeys.keys()).items()])
+                keyvals.difference_update(counts.keys())
+            if keyvals:
+                newcounts = planner.key_counts(cls, keys, keyvals)
+                if backend is not None:
+                    caching.set_many(backend, dict([
+                        (caching.count_key(cls, dict(zip(keys, val))),
+                         count) for val, count in newcounts.items()]),
+                        cls.taggable_count_cache_timeout)
+                counts.update(newcounts)
+            results.update([(resultkey, counts[val])
+                            for resultkey, val in items])
+        return results
 
     @classmethod
     def _check_fields(cls, allfields=False, includetag=False, **fields):
-        keys_set = set(fields.keys())
         if includetag:
             tagged_fields = cls.taggable_taggedfields
         else:
             tagged_fields = cls.taggable_taggedfields_notag
-        if allfields:
-            if keys_set ^ tagged_fields:
-                raise InvalidFields
-        else:
-            if keys_set - tagged_fields:
-                raise InvalidFields
+        if not tagged_fields.issuperset(fields):
+            raise InvalidFields
+        if allfields and len(fields) != len(tagged_fields):
+            raise InvalidFields
 
     @classmethod
+    @instrumented('add_tag')
     def add_tag(cls, tag, **fields):
         cls._check_fields(allfields=True, includetag=False, **fields)
         fields['tag'] = tag
         try:
-            return cls.objects.get(**fields)
+            obj = cls.objects.get(**fields)
+            note(rows=0)
         except cls.DoesNotExist:
             obj = cls(**fields)
             obj.save()
-            return obj
+            note(rows=1)
+        return obj
 
     @classmethod
+    @instrumented('update_tags')
     def update_tags(cls, tags, **fields):
+        """Sets the tags of an object, removing the tags not in ``tags``.
+
+        The current tags are read with a single query, the missing tags are
+        inserted with a single statement, and the stats tables are updated
+        with one grouped statement per stats table.
+        Returns a list of tagged objects, one for every tag in ``tags``.
+        """
         cls._check_fields(allfields=True, includetag=False, **fields)
         if not tags:
             tags = []
+        tagpks = [stats.field_value(tag) for tag in tags]
+        current = dict([(tagged.tag_id, tagged) for tagged in
+                        cls.objects.filter(**fields)])
         # remove old tags
-        cls.objects.filter(**fields).exclude(tag__in=tags).delete()
+        wanted = set(tagpks)
+        removed = [tagged.pk for tagpk, tagged in current.items()
+                   if tagpk not in wanted]
+        if removed:
+            cls.objects.filter(pk__in=removed).delete()
         # set new tags
-        return [cls.add_tag(tag, **fields) for tag in tags]
+        rowfields = dict([(cls.taggable_attnames[field],
+                           stats.field_value(value))
+                          for field, value in fields.items()])
+        newpks, newobjs = set(), []
+        for tagpk in tagpks:
+            if tagpk in current or tagpk in newpks:
+                continue
+            newpks.add(tagpk)
+            newobjs.append(cls(tag_id=tagpk, **rowfields))
+        if newobjs:
+            stats.bulk_insert(cls, newobjs)
+            changes.added(cls, [stats.tagged_row(tagged)
+                                for tagged in newobjs])
+            current.update([(tagged.tag_id, tagged) for tagged in
+                            cls.objects.filter(tag__in=newpks, **fields)])
+        note(rows=len(removed) + len(newobjs))
+        return [current[tagpk] for tagpk in tagpks]
+
+    @classmethod
+    def tag_pks(cls, names, create=True):
+        """Returns a ``{name: pk}`` dict for a list of tag names.
+
+        Names are resolved through the ``Taggable.tag_dictionary`` cache,
+        see :meth:`taggable.tagdict.TagDictionary.lookup`: known names need
+        no query, and with ``create`` the missing tags are inserted.
+        """
+        if cls.taggable_tagdict is None:
+            raise ImproperlyConfigured('%s has no Taggable.tag_dictionary'
+                                       % cls.__name__)
+        return cls.taggable_tagdict.lookup(names, create)
 
     @classmethod
-    def get_tags(cls, counts=False, qfilter=None, **fields):
+    def add_tag_by_name(cls, name, **fields):
+        "Like :meth:`add_tag`, with a tag name, creating the tag if needed."
+        cls._check_fields(allfields=True, includetag=False, **fields)
+        tagmodel = cls._meta.get_field('tag').rel.to
+        return cls.add_tag(tagmodel(pk=cls.tag_pks([name])[name]), **fields)
+
+    @classmethod
+    def update_tags_by_name(cls, names, **fields):
+        "Like :meth:`update_tags`, with tag names, creating missing tags."
+        cls._check_fields(allfields=True, includetag=False, **fields)
+        names = names or []
+        pks = cls.tag_pks(names)
+        return cls.update_tags([pks[name] for name in names], **fields)
+
+    @classmethod
+    def purge(cls, chunk_size=stats.CHUNK_SIZE, **fields):
+        """Deletes all the tagged rows of an object, in chunks.
+
+        ``fields`` is a single tagged field, e.g. ``tag=tag``. Deleting an
+        object already cascades to its tagged rows, but django loads them
+        all in a single transaction first; purging the rows before that
+        keeps huge cascades in small transactions.
+        See :func:`taggable.changes.purge`, returns the number of rows.
+        """
+        cls._check_fields(allfields=False, includetag=True, **fields)
+        if len(fields) != 1:
+            raise InvalidFields
+        fieldname, value = fields.items()[0]
+        return changes.purge(cls, fieldname, value, chunk_size)
+
+    @classmethod
+    def add_tags_bulk(cls, rows, chunk_size=stats.CHUNK_SIZE):
+        """Tags many objects at once.
+
+        ``rows`` is an iterable of dicts with values for all the tagged
+        fields (including ``tag``). The rows are processed in chunks of
+        ``chunk_size``: every chunk is checked against the existing rows with
+        a single query, the new rows are inserted with a single statement and
+        the stats tables are updated with aggregated increments.
+        Returns a ``(created, existing)`` tuple with the number of rows.
+        """
+        fieldnames = sorted(cls.taggable_taggedfields)
+        attnames = [cls.taggable_attnames[field] for field in fieldnames]
+        created, existing = 0, 0
+        for chunk in stats.chunked(rows, chunk_size):
+            # duplicates in previous chunks are found in the database
+            keyvals, seen = [], set()
+            for fields in chunk:
+                cls._check_fields(allfields=True, includetag=True, **fields)
+                keyval = tuple([stats.field_value(fields[field])
+                                for field in fieldnames])
+                if keyval in seen:
+                    existing += 1
+                    continue
+                seen.add(keyval)
+                keyvals.append(keyval)
+            if not keyvals:
+                continue
+            found = set(cls.objects.filter(
+                stats.keys_q(fieldnames, keyvals)).values_list(*fieldnames))
+            newvals = [val for val in keyvals if val not in found]
+            existing += len(keyvals) - len(newvals)
+            if not newvals:
+                continue
+            stats.bulk_insert(cls, [cls(**dict(zip(attnames, val)))
+                                    for val in newvals])
+            changes.added(cls, [dict(zip(fieldnames, val))
+                                for val in newvals])
+            created += len(newvals)
+        return created, existing
+
+    @classmethod
+    def get_tags(cls, counts=False, qfilter=None, lightweight=False,
+                 top=None, min_count=None, buckets=None, **fields):
         return cls.get_tagged_fields(fieldname='tag',
                                      counts=counts,
                                      qfilter=qfilter,
+                                     lightweight=lightweight,
+                                     top=top,
+                                     min_count=min_count,
+                                     buckets=buckets,
                                      **fields)
 
     @classmethod
+    @instrumented('get_tagged_fields')
     def get_tagged_fields(cls, fieldname, counts=False, qfilter=None,
-                          **fields):
-        cls._check_fields(allfields=False, includetag=True, **fields)
-        if cls.taggable_sorted_stats:
-            model = cls._meta.get_field_by_name(fieldname)[0].rel.to
-            tagfields = ['%s__%s' % (fieldname, t) for t in
-                         model.taggable_fields]
-            fields_keys_set = set(fields.keys() + [fieldname])
-            for keys, statsmodel in cls.taggable_sorted_stats:
-                if set(keys) ^ fields_keys_set:
-                    continue
-                # we found a usable stats table for this query
-                qset = statsmodel.objects.select_related(
-                    fieldname).filter(**fields)
-                if counts:
-                    qset = qset.values(*tagfields + ['count'])
-                else:
-                    qset = qset.values(*tagfields).distinct()
-                return queryset_filter_with_counts(qset, fieldname,
-                                                    qfilter, model, counts)
-        # no usable stats table
-        # we fall back to queryset.get_tagged_fields()
-        return cls.objects.filter(**fields).get_tagged_fields(fieldname,
-            counts=counts, qfilter=qfilter)
+                          lightweight=False, top=None, min_count=None,
+                          buckets=None, **fields):
+        """Returns the tags (or objects of another tagged field) for fields.
+
+        With ``lightweight=True``, :class:`taggable.querysets.TagRecord`
+        objects are returned instead of model instances.
+        ``top`` returns only the N tags with the highest counts and
+        ``min_count`` the tags with at least that count, both in SQL.
+        ``buckets`` sets a ``weight`` between 1 and N on every tag, to be
+        used in tag clouds. All of them imply ``counts=True``.
+        """
+        route = planner.route(cls, fields, fieldname)
+        counts = counts or bool(top or min_count or buckets)
+        # a qfilter can use the count annotation, that can't be added
+        # when aggregating stats tables, since they have a count field
+        chosen = planner.choose(route, aggregate=not (counts and qfilter))
+        note(plan=chosen)
+        if chosen.fallback:
+            # no usable stats table
+            # we fall back to queryset.get_tagged_fields()
+            return cls.objects.filter(**fields).get_tagged_fields(fieldname,
+                counts=counts, qfilter=qfilter, lightweight=lightweight,
+                top=top, min_count=min_count, buckets=buckets)
+        qset, countname = cls._stats_values(fieldname, route, chosen, counts,
+                                            fields)
+        return queryset_filter_with_counts(qset, fieldname, qfilter,
+            route.model, counts, lightweight, top, min_count, buckets,
+            countname)
+
+    @classmethod
+    def iter_tags(cls, counts=False, lightweight=False, min_count=None,
+                  chunk_size=stats.CHUNK_SIZE, **fields):
+        return cls.iter_tagged_fields(fieldname='tag',
+                                      counts=counts,
+                                      lightweight=lightweight,
+                                      min_count=min_count,
+                                      chunk_size=chunk_size,
+                                      **fields)
+
+    @classmethod
+    @instrumented('iter_tagged_fields')
+    def iter_tagged_fields(cls, fieldname, counts=False, lightweight=False,
+                           min_count=None, chunk_size=stats.CHUNK_SIZE,
+                           **fields):
+        """Streams the tags (or objects of another tagged field) for fields.
+
+        Like :meth:`get_tagged_fields`, but the tags are read in chunks of
+        ``chunk_size``, ordered by primary key (keyset pagination), so the
+        memory used doesn't depend on the number of tags.
+        """
+        route = planner.route(cls, fields, fieldname)
+        counts = counts or bool(min_count)
+        chosen = planner.choose(route)
+        note(plan=chosen)
+        if chosen.fallback:
+            return cls.objects.filter(**fields).iter_tagged_fields(fieldname,
+                counts=counts, lightweight=lightweight, min_count=min_count,
+                chunk_size=chunk_size)
+        qset, countname = cls._stats_values(fieldname, route, chosen, counts,
+                                            fields)
+        return queryset_iter_with_counts(qset, fieldname, route.model,
+            counts, lightweight, min_count, chunk_size, countname)
+
+    @classmethod
+    def get_tags_page(cls, per_page=20, cursor=None, lightweight=False,
+                      **fields):
+        return cls.get_tagged_fields_page(fieldname='tag',
+                                          per_page=per_page,
+                                          cursor=cursor,
+                                          lightweight=lightweight,
+                                          **fields)
+
+    @classmethod
+    def get_tagged_fields_page(cls, fieldname, per_page=20, cursor=None,
+                               lightweight=False, **fields):
+        """Returns a page of tags with counts, and the next page cursor.
+
+        The tags are ordered by count, then by primary key. ``cursor`` is
+        None for the first page, and the returned cursor is None on the
+        last page. Pages start after the last tag of the previous page
+        (keyset pagination), so deep pages cost the same as the first one.
+        Raises InvalidCursor for bad cursors.
+        """
+        route = planner.route(cls, fields, fieldname)
+        chosen = planner.choose(route)
+        if chosen.fallback:
+            return cls.objects.filter(**fields).get_tagged_fields_page(
+                fieldname, per_page, cursor, lightweight)
+        qset, countname = cls._stats_values(fieldname, route, chosen, True,
+                                            fields)
+        return queryset_count_page(qset, fieldname, route.model, per_page,
+                                   cursor, lightweight, countname)
+
+    @classmethod
+    @instrumented('autocomplete')
+    def autocomplete(cls, prefix, top=10, lightweight=False, **fields):
+        """Returns the ``top`` tags starting with ``prefix``, with counts.
+
+        The tags are ordered by count, then by primary key. Scopes warmed
+        with :meth:`warm_autocomplete` are searched in memory, without
+        queries; otherwise the tag names are matched with ``istartswith``
+        on the table chosen by the planner.
+        """
+        route = planner.route(cls, fields, 'tag')
+        tags = cls.taggable_autocomplete.search(prefix, top, lightweight,
+                                                fields)
+        if tags is not None:
+            note(rows=len(tags))
+            return tags
+        chosen = planner.choose(route)
+        note(plan=chosen)
+        match = {'tag__%s__istartswith' % cls.taggable_autocomplete.name:
+                 prefix}
+        pkfield = 'tag__%s' % route.model._meta.pk.name
+        if chosen.fallback:
+            return list(cls.objects.filter(**fields).filter(
+                **match).get_tags(counts=True, lightweight=lightweight,
+                qfilter=lambda qset: qset.order_by('-count', pkfield),
+                top=top))
+        qset, countname = cls._stats_values('tag', route, chosen, True,
+                                            fields)
+        qset = qset.filter(**match).order_by('-%s' % countname, pkfield)
+        return list(queryset_filter_with_counts(qset, 'tag', None,
+            route.model, True, lightweight, top, countname=countname))
+
+    @classmethod
+    def warm_autocomplete(cls, **fields):
+        """Loads the in-memory autocomplete index of a scope.
+
+        The index is then kept up to date with the tagged rows changes of
+        this process, and reloaded after ``Taggable.autocomplete_ttl``
+        seconds. See :class:`taggable.autocomplete.Autocomplete`, returns
+        the number of indexed tags.
+        """
+        planner.route(cls, fields, 'tag')
+        return cls.taggable_autocomplete.warm(fields)
+
+    @classmethod
+    def _stats_values(cls, fieldname, route, chosen, counts, fields):
+        """Returns the values_list() queryset on the stats table of a plan.
+
+        Returns a ``(queryset, count annotation name)`` tuple.
+        """
+        qset = chosen.statsmodel.objects.select_related(
+            fieldname).filter(**fields)
+        if not counts:
+            return qset.values_list(*route.tagfields).distinct(), 'count'
+        if chosen.aggregate:
+            return qset.values_list(*route.tagfields).annotate(
+                taggable_count=Sum('count')), 'taggable_count'
+        return qset.values_list(*route.countfields), 'count'
 
     class Meta:
         "Abstract model."
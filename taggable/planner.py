@@ -0,0 +1,178 @@
+"Taggable query planner, chooses the table used to answer a tag query"
+
+import time
+
+from django.db.models import Count, Sum
+from taggable import instrumentation, stats
+from taggable.exceptions import InvalidFields
+
+
+# seconds a row count estimate is cached
+ESTIMATE_TTL = 300
+
+# cached row count estimates: {model: (rows, expiration time)}
+_estimates = {}
+
+
+class Plan(object):
+    """The table chosen to answer a query.
+
+    ``statsmodel`` is the stats table used, or None when the query falls
+    back to the tagged table. When ``aggregate`` is True the stats table
+    has more keys than the query (or is sharded), and its counts are
+    summed.
+    """
+
+    def __init__(self, cls, keys=None, aggregate=False):
+        self.cls = cls
+        self.keys = keys
+        self.aggregate = aggregate
+        if keys is None:
+            self.statsmodel = None
+        else:
+            self.statsmodel = cls.taggable_stats[keys]
+
+    @property
+    def fallback(self):
+        return self.statsmodel is None
+
+    @property
+    def model(self):
+        "The model that is queried."
+        if self.statsmodel is None:
+            return self.cls
+        return self.statsmodel
+
+    def __repr__(self):
+        if self.statsmodel is None:
+            kind = 'fallback'
+        elif self.aggregate:
+            kind = 'aggregate'
+        else:
+            kind = 'exact'
+        return '<Plan: %s (%s)>' % (self.model._meta.object_name, kind)
+
+
+class Route(object):
+    """The precomputed routing of a query on a set of tagged fields.
+
+    ``keys`` are the sorted fields needed by the query (the filtered
+    fields plus the listed field), ``exact`` the plan on the stats table
+    with these keys (or None), ``aggregates`` the plans on the stats tables
+    with more keys, and ``fallback`` the plan on the tagged table.
+    When the query lists a field, ``model`` is the related model,
+    ``tagfields`` the values_list() fields used to build its objects and
+    ``countfields`` the same fields followed by ``count``.
+    """
+    __slots__ = ('keys', 'exact', 'aggregates', 'fallback', 'model',
+                 'tagfields', 'countfields')
+
+
+def _table_rows(model):
+    "Returns an estimate of the number of rows of a model's table."
+    using = stats.db_for_read(model)
+    name = stats.vendor(using)
+    table = model._meta.db_table
+    cursor = stats.get_connection(using).cursor()
+    if name == 'postgresql':
+        cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s',
+                       [table])
+    elif name == 'mysql':
+        cursor.execute('SELECT table_rows FROM information_schema.tables '
+                       'WHERE table_schema = DATABASE() '
+                       'AND table_name = %s', [table])
+    else:
+        return model.objects.count()
+    row = cursor.fetchone()
+    if row is None or row[0] is None or row[0] <= 0:
+        # no statistics yet
+        return model.objects.count()
+    return int(row[0])
+
+
+def estimate_rows(model):
+    "Returns a cached estimate of the number of rows of a model's table."
+    now = time.time()
+    cached = _estimates.get(model)
+    if cached is None or cached[1] < now:
+        cached = _estimates[model] = (_table_rows(model), now + ESTIMATE_TTL)
+    return cached[0]
+
+
+def route(cls, fieldnames, fieldname=None):
+    """Returns the :class:`Route` of a query on a tagged model.
+
+    ``fieldnames`` is an iterable with the filtered fields (a dict of
+    fields works), and ``fieldname`` is the field whose objects are
+    listed, if any. Raises InvalidFields for unknown fields.
+    """
+    try:
+        return cls.taggable_routes[fieldname][frozenset(fieldnames)]
+    except KeyError:
+        raise InvalidFields
+
+
+def choose(route, aggregate=True):
+    """Chooses the table used to answer a query with a :class:`Route`.
+
+    A stats table with exactly the needed keys is always used (if it's
+    sharded, only when ``aggregate`` is allowed). Otherwise, if
+    ``aggregate`` is allowed, the smallest stats table with all the needed
+    keys is compared with the tagged table using cached row count
+    estimates.
+    """
+    if route.exact is not None and (aggregate or
+                                    not route.exact.aggregate):
+        return route.exact
+    if not aggregate or not route.aggregates:
+        return route.fallback
+    best, rows = None, estimate_rows(route.fallback.cls)
+    for candidate in route.aggregates:
+        candidate_rows = estimate_rows(candidate.statsmodel)
+        if candidate_rows < rows:
+            best, rows = candidate, candidate_rows
+    return best or route.fallback
+
+
+def plan(cls, fieldnames, fieldname=None, aggregate=True):
+    "Chooses the table to count tagged rows matching a set of fields."
+    return choose(route(cls, fieldnames, fieldname), aggregate)
+
+
+def tag_count(cls, fields):
+    "Returns the number of tagged rows that match a dict of fields."
+    chosen = plan(cls, fields)
+    instrumentation.note(plan=chosen)
+    if chosen.fallback:
+        return cls.objects.filter(**fields).count()
+    qset = chosen.statsmodel.objects.filter(**fields)
+    if chosen.aggregate:
+        return qset.aggregate(total=Sum('count'))['total'] or 0
+    try:
+        return qset.get().count
+    except chosen.statsmodel.DoesNotExist:
+        return 0
+
+
+def key_counts(cls, keys, keyvals):
+    """Returns a dict with the tag count of a list of key values.
+
+    Reads the stats table chosen by :func:`plan`, or uses a grouped COUNT
+    over the tagged table. One query per chunk of keys.
+    """
+    if not keys:
+        return {(): tag_count(cls, {})}
+    counts = dict([(val, 0) for val in keyvals])
+    chosen = plan(cls, keys)
+    for chunk in stats.chunked(counts.keys()):
+        qset = chosen.model.objects.filter(stats.keys_q(keys, chunk))
+        if chosen.fallback:
+            qset = qset.values_list(*keys).annotate(
+                taggable_count=Count('pk')).order_by()
+        elif chosen.aggregate:
+            qset = qset.values_list(*keys).annotate(
+                taggable_count=Sum('count')).order_by()
+        else:
+            qset = qset.values_list(*(keys + ('count', )))
+        counts.update([(tuple(row[:-1]), row[-1]) for row in qset])
+    return counts
@@ -1,69 +1,434 @@
 "Taggable querysets"
 
+import base64
+import math
+
 from django.db import models
+from django.utils import simplejson
+from taggable import changes, planner, stats
+from taggable.exceptions import InvalidCursor
+from taggable.instrumentation import instrumented, measuring, note, \
+    unmeasured
 
 
 def fieldname_to_model(queryset, fieldname):
     return queryset.model._meta.get_field_by_name(fieldname)[0].rel.to
 
 
-def queryset_filter_with_counts(qset, fieldname, qfilter, model, counts):
+class TagRecord(object):
+    """Lightweight tag, with the tag fields and a ``count`` attribute.
+
+    Returned instead of tag model instances when using ``lightweight=True``.
+    """
+    __slots__ = ()
+
+    def __init__(self, row):
+        for name, value in zip(self.__slots__, row):
+            setattr(self, name, value)
+        if len(row) < len(self.__slots__) - 1:
+            self.count = None
+        self.weight = None
+
+    def __repr__(self):
+        return '<%s: %s>' % (type(self).__name__, ', '.join(
+            ['%s=%r' % (name, getattr(self, name))
+             for name in self.__slots__]))
+
+
+def record_class(model):
+    "Returns a TagRecord subclass for a tag model."
+    return type('%sRecord' % model.__name__, (TagRecord, ),
+                {'__slots__': tuple(model.taggable_fieldlist) +
+                              ('count', 'weight')})
+
+
+def tag_values(fieldname, model):
+    "Returns the values_list() fields used to build tags from a query."
+    return ['%s__%s' % (fieldname, t) for t in model.taggable_fieldlist]
+
+
+def assign_weights(tags, buckets):
+    """Sets the ``weight`` of a list of tags with counts, from 1 to buckets.
+
+    The weights are distributed on a logarithmic scale between the lowest
+    and the highest count, as usual in tag clouds.
+    """
+    if not tags:
+        return tags
+    counts = [math.log(tag.count) for tag in tags]
+    low, high = min(counts), max(counts)
+    spread = high - low
+    for tag, count in zip(tags, counts):
+        if not spread:
+            tag.weight = 1
+        else:
+            tag.weight = min(buckets,
+                             1 + int((count - low) * buckets / spread))
+    return tags
+
+
+def queryset_filter_with_counts(qset, fieldname, qfilter, model, counts,
+                                lightweight=False, top=None, min_count=None,
+                                buckets=None, countname='count'):
+    """Builds tags from the rows of a values_list() queryset.
+
+    The rows have the :func:`tag_values` fields, and the count at the end.
+    ``min_count`` and ``top`` are applied in SQL, and ``buckets`` sets the
+    weight of every tag (see :func:`assign_weights`).
+    """
     if qfilter is not None:
         qset = qfilter(qset)
-    for tagdata in qset:
-        tag = model(**dict(
-            [(t, tagdata['%s__%s' % (fieldname, t)]) for t in
-             model.taggable_fields]))
-        if counts:
-            tag.count = tagdata['count']
+    if min_count:
+        qset = qset.filter(**{'%s__gte' % countname: min_count})
+    if top:
+        qset = qset.order_by('-%s' % countname, '%s__%s' % (
+            fieldname, model._meta.pk.name))
+        qset = qset[:top]
+    tags = _build_tags(qset, model, counts, lightweight)
+    if buckets:
+        tags = assign_weights(list(tags), buckets)
+    for tag in tags:
         yield tag
 
 
+def keyset_rows(qset, fieldname, model, chunk_size):
+    """Iterates over the rows of a :func:`tag_values` queryset in chunks.
+
+    Every chunk is a query ordered by the primary key of ``fieldname``,
+    starting after the last primary key of the previous chunk.
+    """
+    pkname = model._meta.pk.name
+    pkfield = '%s__%s' % (fieldname, pkname)
+    pkindex = model.taggable_fieldlist.index(pkname)
+    qset = qset.order_by(pkfield)
+    chunk = qset
+    while True:
+        rows = list(chunk[:chunk_size])
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            break
+        chunk = qset.filter(**{'%s__gt' % pkfield: rows[-1][pkindex]})
+
+
+def queryset_iter_with_counts(qset, fieldname, model, counts,
+                              lightweight=False, min_count=None,
+                              chunk_size=stats.CHUNK_SIZE, countname='count'):
+    """Streams tags from the rows of a values_list() queryset.
+
+    Like :func:`queryset_filter_with_counts`, with the rows read by
+    :func:`keyset_rows`.
+    """
+    if min_count:
+        qset = qset.filter(**{'%s__gte' % countname: min_count})
+    return _build_tags(keyset_rows(qset, fieldname, model, chunk_size),
+                       model, counts, lightweight)
+
+
+def encode_cursor(values):
+    "Returns an opaque pagination cursor with a list of values."
+    return base64.urlsafe_b64encode(simplejson.dumps(values))
+
+
+def decode_cursor(cursor, length):
+    "Returns the list of values of a cursor, raises InvalidCursor."
+    try:
+        values = simplejson.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise InvalidCursor
+    if not isinstance(values, list) or len(values) != length:
+        raise InvalidCursor
+    return values
+
+
+def count_page(qset, fieldname, model, per_page, cursor=None,
+               countname='count'):
+    """Returns a page of the rows of a values_list() queryset with counts.
+
+    The rows are ordered by count (descending), then by the primary key of
+    ``fieldname``, and the page starts after the row of the ``cursor``
+    (keyset pagination), so every page costs the same.
+    Returns a ``(rows, next cursor)`` tuple, the cursor is None on the
+    last page.
+    """
+    pkname = model._meta.pk.name
+    pkfield = '%s__%s' % (fieldname, pkname)
+    pkindex = model.taggable_fieldlist.index(pkname)
+    qset = qset.order_by('-%s' % countname, pkfield)
+    if cursor is None:
+        rows = list(qset[:per_page + 1])
+    else:
+        count, pk = decode_cursor(cursor, 2)
+        # the ORM can't OR a condition on an aggregate with a condition
+        # on a field, so the rows with the same count are read first
+        rows = list(qset.filter(**{countname: count,
+                                   '%s__gt' % pkfield: pk})[:per_page + 1])
+        if len(rows) <= per_page:
+            rows += list(qset.filter(**{'%s__lt' % countname: count})[
+                :per_page + 1 - len(rows)])
+    if len(rows) <= per_page:
+        return rows, None
+    rows = rows[:per_page]
+    return rows, encode_cursor([rows[-1][-1], rows[-1][pkindex]])
+
+
+def queryset_count_page(qset, fieldname, model, per_page, cursor=None,
+                        lightweight=False, countname='count'):
+    """Returns a page of tags with counts, see :func:`count_page`.
+
+    Returns a ``(tags, next cursor)`` tuple.
+    """
+    rows, next_cursor = count_page(qset, fieldname, model, per_page, cursor,
+                                   countname)
+    return list(_build_tags(rows, model, True, lightweight)), next_cursor
+
+
+def pk_page(qset, per_page, cursor=None):
+    """Returns a page of the objects of a queryset, ordered by primary key.
+
+    Returns a ``(objects, next cursor)`` tuple, the cursor is None on the
+    last page.
+    """
+    qset = qset.order_by('pk')
+    if cursor is not None:
+        qset = qset.filter(pk__gt=decode_cursor(cursor, 1)[0])
+    objects = list(qset[:per_page + 1])
+    if len(objects) <= per_page:
+        return objects, None
+    objects = objects[:per_page]
+    return objects, encode_cursor([objects[-1].pk])
+
+
+def _build_tags(qset, model, counts, lightweight):
+    if lightweight:
+        record = model.taggable_record
+        for row in qset:
+            yield record(row)
+    elif counts:
+        nfields = len(model.taggable_fieldlist)
+        for row in qset:
+            tag = model(*row[:nfields])
+            tag.count = row[nfields]
+            yield tag
+    else:
+        for row in qset:
+            yield model(*row)
+
+
 class TaggedQuerySet(models.query.QuerySet):
     "Queryset for the Tagged abstract class."
 
+    @instrumented('delete')
     def delete(self):
-        "Removes a set of tagged objects and updates the stats tables."
-        for tagged in self:
-            for fields, statsmodel in tagged.taggable_stats.items():
-                qdict = dict(tagged.taggable_get_fields(fields))
-                statsmodel.objects.filter(**qdict).filter(
-                    count__lte=1).delete()
-                statsmodel.objects.filter(**qdict).filter(
-                    count__gte=2).update(count=models.F('count') - 1)
+        """Removes a set of tagged objects and updates the stats tables.
+
+        The removed rows are aggregated with one GROUP BY query per stats
+        table, and the decrements are applied in bulk, so the number of
+        queries doesn't depend on the number of removed rows.
+        """
+        assert self.query.can_filter(), \
+                "Cannot use 'limit' or 'offset' with delete."
+        removed = changes.removing(self)
+        rows = None
+        if 'rows' in removed:
+            rows = len(removed['rows'])
+        elif removed['deltas']:
+            # the deltas of any stats table add up to the removed rows
+            rows = -sum(removed['deltas'].values()[0].values())
+        elif measuring():
+            # not a statement of the delete itself
+            rows = unmeasured(self.count)
         super(TaggedQuerySet, self).delete()
+        changes.removed(self.model, removed)
+        note(rows=rows)
 
-    def get_tags(self, counts=False, qfilter=None):
+    def get_tags(self, counts=False, qfilter=None, lightweight=False,
+                 top=None, min_count=None, buckets=None):
         return self.get_tagged_fields(fieldname='tag',
                                       counts=counts,
-                                      qfilter=qfilter)
+                                      qfilter=qfilter,
+                                      lightweight=lightweight,
+                                      top=top,
+                                      min_count=min_count,
+                                      buckets=buckets)
 
-    def get_tagged_fields(self, fieldname, counts=False, qfilter=None):
-        model = fieldname_to_model(self, fieldname)
-        tagfields = ['%s__%s' % (fieldname, t) for t in
-                     model.taggable_fields]
-        qset = self.select_related(fieldname).values(*tagfields)
+    @instrumented('get_tagged_fields')
+    def get_tagged_fields(self, fieldname, counts=False, qfilter=None,
+                          lightweight=False, top=None, min_count=None,
+                          buckets=None):
+        counts = counts or bool(top or min_count or buckets)
+        return queryset_filter_with_counts(
+            self._tagged_values(fieldname, counts), fieldname, qfilter,
+            fieldname_to_model(self, fieldname), counts, lightweight, top,
+            min_count, buckets)
+
+    def iter_tags(self, counts=False, lightweight=False, min_count=None,
+                  chunk_size=stats.CHUNK_SIZE):
+        return self.iter_tagged_fields(fieldname='tag',
+                                       counts=counts,
+                                       lightweight=lightweight,
+                                       min_count=min_count,
+                                       chunk_size=chunk_size)
+
+    @instrumented('iter_tagged_fields')
+    def iter_tagged_fields(self, fieldname, counts=False, lightweight=False,
+                           min_count=None, chunk_size=stats.CHUNK_SIZE):
+        """Streams the objects ``fieldname`` points to, in chunks.
+
+        See :meth:`taggable.models.Tagged.iter_tagged_fields`.
+        """
+        counts = counts or bool(min_count)
+        return queryset_iter_with_counts(
+            self._tagged_values(fieldname, counts), fieldname,
+            fieldname_to_model(self, fieldname), counts, lightweight,
+            min_count, chunk_size)
+
+    def _tagged_values(self, fieldname, counts):
+        "Returns the values_list() queryset of get_tagged_fields()."
+        tagfields = tag_values(fieldname, fieldname_to_model(self, fieldname))
+        qset = self.select_related(fieldname).values_list(*tagfields)
         if counts:
-            qset = qset.annotate(count=models.Count('%s__id' % fieldname))
-        else:
-            qset = qset.distinct()
-        return queryset_filter_with_counts(qset, fieldname, qfilter,
-                                            model, counts)
+            return qset.annotate(count=models.Count('%s__id' % fieldname))
+        return qset.distinct()
+
+    def get_tags_page(self, per_page=20, cursor=None, lightweight=False):
+        return self.get_tagged_fields_page(fieldname='tag',
+                                           per_page=per_page,
+                                           cursor=cursor,
+                                           lightweight=lightweight)
+
+    def get_tagged_fields_page(self, fieldname, per_page=20, cursor=None,
+                               lightweight=False):
+        """Returns a page of the objects ``fieldname`` points to, with counts.
+
+        See :meth:`taggable.models.Tagged.get_tagged_fields_page`.
+        """
+        return queryset_count_page(self._tagged_values(fieldname, True),
+            fieldname, fieldname_to_model(self, fieldname), per_page, cursor,
+            lightweight)
 
     def get_tagged_related(self, fieldname):
         return fieldname_to_model(self, fieldname).objects.filter(
             id__in=self.values('%s__id' % fieldname).distinct())
 
+    def get_tagged_related_page(self, fieldname, per_page=20, cursor=None):
+        """Returns a page of :meth:`get_tagged_related`, see :func:`pk_page`.
+
+        Returns a ``(objects, next cursor)`` tuple.
+        """
+        return pk_page(self.get_tagged_related(fieldname), per_page, cursor)
+
+    def tagged_with_any(self, tags, fieldname):
+        """Returns the objects ``fieldname`` points to that have any of tags.
+
+        Uses a single ``tag IN (...)`` subquery.
+        """
+        tagpks = [stats.field_value(tag) for tag in tags]
+        return fieldname_to_model(self, fieldname).objects.filter(
+            pk__in=self.filter(tag__in=tagpks).values(fieldname).distinct())
+
+    def tagged_with_all(self, tags, fieldname):
+        """Returns the objects ``fieldname`` points to that have all the tags.
+
+        Uses a single GROUP BY ... HAVING COUNT(DISTINCT tag) = N subquery,
+        restricted to the objects with the most selective tag. The
+        selectivity is estimated with a stats table having a ``tag`` key when
+        there is one; the stats only order the tags, since they can be
+        deferred or out of date.
+        """
+        model = fieldname_to_model(self, fieldname)
+        tagpks = list(set([stats.field_value(tag) for tag in tags]))
+        if not tagpks:
+            return model.objects.none()
+        if not planner.plan(self.model, ('tag', )).fallback:
+            counts = planner.key_counts(self.model, ('tag', ),
+                                        [(tagpk, ) for tagpk in tagpks])
+            tagpks.sort(key=lambda tagpk: counts[(tagpk, )])
+        qset = self.filter(tag__in=tagpks)
+        if len(tagpks) > 1:
+            qset = qset.filter(**{'%s__in' % fieldname: self.filter(
+                tag=tagpks[0]).values(fieldname)})
+            qset = qset.values(fieldname).annotate(
+                taggable_count=models.Count('tag', distinct=True)).filter(
+                taggable_count=len(tagpks))
+        return model.objects.filter(pk__in=qset.values(fieldname))
+
+    def prefetch_tags(self, objects, fieldname, attr='tags', qfilter=None,
+                      lightweight=False):
+        """Fetches the tags of a list of objects.
+
+        ``objects`` are instances of the model ``fieldname`` points to. Their
+        tags are fetched with one query (per chunk of objects), and stored
+        as a list (of records with ``lightweight``) in the ``attr``
+        attribute of every object.
+        Returns the list of objects.
+        """
+        objects = list(objects)
+        model = fieldname_to_model(self, 'tag')
+        tagfields = tag_values('tag', model)
+        bypk = {}
+        for obj in objects:
+            setattr(obj, attr, bypk.setdefault(obj.pk, []))
+        for chunk in stats.chunked(bypk.keys()):
+            qset = self.filter(**{'%s__in' % fieldname: chunk}).select_related(
+                'tag').values_list(*[fieldname] + tagfields).distinct()
+            if qfilter is not None:
+                qset = qfilter(qset)
+            rows = list(qset)
+            tags = _build_tags([values[1:] for values in rows], model, False,
+                               lightweight)
+            for row, tag in zip(rows, tags):
+                bypk[row[0]].append(tag)
+        return objects
+
 
 class EmptyTaggedQuerySet(models.query.EmptyQuerySet):
 
-    def get_tags(self, counts=False, qfilter=None):
+    def get_tags(self, counts=False, qfilter=None, lightweight=False,
+                 top=None, min_count=None, buckets=None):
         return self.get_tagged_fields(fieldname='tag',
                                       counts=counts,
-                                      qfilter=qfilter)
+                                      qfilter=qfilter,
+                                      lightweight=lightweight,
+                                      top=top,
+                                      min_count=min_count,
+                                      buckets=buckets)
 
-    def get_tagged_fields(self, fieldname, counts=False, qfilter=None):
+    def get_tagged_fields(self, fieldname, counts=False, qfilter=None,
+                          lightweight=False, top=None, min_count=None,
+                          buckets=None):
         return fieldname_to_model(self, fieldname).objects.none()
 
+    def iter_tags(self, counts=False, lightweight=False, min_count=None,
+                  chunk_size=stats.CHUNK_SIZE):
+        return iter([])
+
+    def iter_tagged_fields(self, fieldname, counts=False, lightweight=False,
+                           min_count=None, chunk_size=stats.CHUNK_SIZE):
+        return iter([])
+
+    def get_tags_page(self, per_page=20, cursor=None, lightweight=False):
+        return [], None
+
+    def get_tagged_fields_page(self, fieldname, per_page=20, cursor=None,
+                               lightweight=False):
+        return [], None
+
     def get_tagged_related(self, fieldname):
         return fieldname_to_model(self, fieldname).objects.none()
+
+    def get_tagged_related_page(self, fieldname, per_page=20, cursor=None):
+        return [], None
+
+    def tagged_with_any(self, tags, fieldname):
+        return fieldname_to_model(self, fieldname).objects.none()
+
+    def tagged_with_all(self, tags, fieldname):
+        return fieldname_to_model(self, fieldname).objects.none()
+
+    def prefetch_tags(self, objects, fieldname, attr='tags', qfilter=None,
+                      lightweight=False):
+        objects = list(objects)
+        for obj in objects:
+            setattr(obj, attr, [])
+        return objects
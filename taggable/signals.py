@@ -1,13 +1,23 @@
 "Taggable signals"
 
-from django.db import models, transaction
+from django.core.signals import request_finished
+from django.db import models
+from taggable import autocomplete, caching, changes, planner, stats, \
+    tagdict
+from taggable.querysets import record_class, tag_values
 
 
 def _handler_obj_delete(signal, sender, instance, **named):
     """ Removes all related tagged stats objects
 
-    Called when a tagged/tag object is delete()d
+    Called when a tagged/tag object is delete()d, see
+    :func:`taggable.changes.purge`. Deleted tags are also removed from the
+    tag dictionaries and autocomplete indexes.
     """
+    for dictionary in getattr(instance, 'taggable_tagdicts', ()):
+        dictionary.discard(instance)
+    for index in getattr(instance, 'taggable_autocompletes', ()):
+        index.discard(instance)
     try:
         # we assume that if we have this property, we're fine
         instance.taggable_on_delete
@@ -15,11 +25,8 @@ def _handler_obj_delete(signal, sender, instance, **named):
         # this is not an object associated to a Tagged model
         return
     for field_name, tagged_model in instance.taggable_on_delete:
-        where = ['%s=%s' % (
-                 tagged_model._meta.get_field_by_name(field_name)[0].column,
-                 instance.pk)]
-        tagged_model.objects.extra(where=where).delete()
-    transaction.commit_unless_managed()
+        changes.purge(tagged_model, field_name, instance.pk,
+                      using=stats.instance_db(instance))
 
 
 def _handler_tagged_subclass(signal, sender, **named):
@@ -33,17 +40,49 @@ def _handler_tagged_subclass(signal, sender, **named):
 
     # we start caching the stats fields
     try:
-        stats = sender.Taggable.stats
+        statsconf = sender.Taggable.stats
     except AttributeError:
-        stats = {}
+        statsconf = {}
 
     sender.taggable_sorted_stats = [
-        (tuple(sorted(k)), v) for (k, v) in stats.items()]
+        (tuple(sorted(k)), v) for (k, v) in statsconf.items()]
     sender.taggable_sorted_stats.sort(key=lambda x: len(x[0]), reverse=True)
     sender.taggable_stats = dict(sender.taggable_sorted_stats)
 
+    # sharded stats tables have a shard field, see stats.shard_deltas()
+    shards = dict([(tuple(sorted(k)), v) for (k, v) in getattr(
+        sender.Taggable, 'stats_shards', {}).items()])
+    for keys, statsmodel in sender.taggable_stats.items():
+        statsmodel.taggable_shards = shards.get(keys, 0)
+
+    sender.taggable_stats_buffer = None
+    if sender.taggable_stats and getattr(sender.Taggable, 'stats_deferred',
+                                         False):
+        sender.taggable_stats_buffer = stats.StatsBuffer(sender,
+            getattr(sender.Taggable, 'stats_buffer_size', 1000),
+            getattr(sender.Taggable, 'stats_flush_interval', 10))
+        stats._buffers.append(sender.taggable_stats_buffer)
+
+    sender.taggable_count_cache = caching.get_backend(
+        getattr(sender.Taggable, 'count_cache', None))
+    sender.taggable_count_cache_timeout = getattr(sender.Taggable,
+        'count_cache_timeout', None)
+    sender.taggable_cooccurrence = getattr(sender.Taggable, 'cooccurrence',
+                                           None)
+    sender.taggable_tag_list = getattr(sender.Taggable, 'tag_list', None)
+    sender.taggable_tag_list_name = getattr(sender.Taggable, 'tag_list_name',
+                                            'name')
+    sender.taggable_autocomplete = autocomplete.Autocomplete(sender,
+        getattr(sender.Taggable, 'autocomplete_name', 'name'),
+        getattr(sender.Taggable, 'autocomplete_ttl', 3600),
+        getattr(sender.Taggable, 'autocomplete_scopes', 100))
+
+    sender.taggable_tagdict = None
+    tagdict_field = getattr(sender.Taggable, 'tag_dictionary', None)
+
     sender.taggable_taggedfields = set()
     sender.taggable_taggedfields_notag = set()
+    sender.taggable_attnames = {}
 
     for field, _ in sender._meta.get_fields_with_model():
         if field.get_internal_type() != 'ForeignKey':
@@ -57,17 +96,107 @@ def _handler_tagged_subclass(signal, sender, **named):
         for stats_fields, _ in sender.taggable_stats.items():
             if field.name not in stats_fields:
                 rel_model.taggable_on_delete.add((field.name, sender))
+        if sender.taggable_count_cache is not None or (
+                sender.taggable_stats_buffer is not None) or (
+                sender.taggable_cooccurrence is not None and
+                field.name != 'tag') or (
+                sender.taggable_tag_list is not None and
+                field.name != sender.taggable_tag_list[0]):
+            # the cached counts, co-occurrences and tag lists are updated
+            # when deleting the rows, and the buffered deltas are flushed
+            # before the stats rows of the object are dropped
+            rel_model.taggable_on_delete.add((field.name, sender))
 
         if field.name != 'tag':
             sender.taggable_taggedfields_notag.add(field.name)
         sender.taggable_taggedfields.add(field.name)
+        sender.taggable_attnames[field.name] = field.attname
 
         rel_model.taggable_fields = set()
+        rel_model.taggable_fieldlist = []
         for rfield, _ in rel_model._meta.get_fields_with_model():
             rel_model.taggable_fields.add(rfield.name)
+            rel_model.taggable_fieldlist.append(rfield.name)
+        rel_model.taggable_record = record_class(rel_model)
+
+        if field.name == 'tag':
+            try:
+                rel_model.taggable_autocompletes
+            except AttributeError:
+                rel_model.taggable_autocompletes = set()
+            rel_model.taggable_autocompletes.add(
+                sender.taggable_autocomplete)
+
+        if field.name == 'tag' and tagdict_field is not None:
+            sender.taggable_tagdict = tagdict.get_dictionary(rel_model,
+                tagdict_field,
+                getattr(sender.Taggable, 'tag_dictionary_size', 10000),
+                getattr(sender.Taggable, 'tag_dictionary_ttl', 300))
+            try:
+                rel_model.taggable_tagdicts
+            except AttributeError:
+                rel_model.taggable_tagdicts = set()
+            rel_model.taggable_tagdicts.add(sender.taggable_tagdict)
+
+    sender.taggable_taggedfields = frozenset(sender.taggable_taggedfields)
+    sender.taggable_taggedfields_notag = frozenset(
+        sender.taggable_taggedfields_notag)
+    sender.taggable_routes = _build_routes(sender)
+
+
+def _build_routes(sender):
+    """Returns the routing table of a tagged model.
+
+    It's a ``{fieldname: {frozenset(fields): route}}`` dict with a
+    :class:`taggable.planner.Route` for every combination of filtered
+    fields and every field that can be listed (``None`` for counts), so
+    routing a query is a dict lookup.
+    """
+    fieldnames = sorted(sender.taggable_taggedfields)
+    fallback = planner.Plan(sender)
+    aggregates = [planner.Plan(sender, keys, aggregate=True)
+                  for keys in sorted(sender.taggable_stats)]
+    combinations = [()]
+    for name in fieldnames:
+        combinations += [fields + (name, ) for fields in combinations]
+    routes = {}
+    for fieldname in [None] + fieldnames:
+        routes[fieldname] = byfields = {}
+        if fieldname is not None:
+            model = sender._meta.get_field(fieldname).rel.to
+            tagfields = tag_values(fieldname, model)
+        for fields in combinations:
+            needed = set(fields)
+            if fieldname is not None:
+                needed.add(fieldname)
+            route = planner.Route()
+            route.keys = tuple(sorted(needed))
+            route.exact = None
+            if route.keys in sender.taggable_stats:
+                # the shards of a key are summed like an aggregate
+                route.exact = planner.Plan(sender, route.keys,
+                    aggregate=bool(sender.taggable_stats[
+                        route.keys].taggable_shards))
+            route.aggregates = [plan for plan in aggregates
+                                if needed.issubset(plan.keys) and
+                                plan.keys != route.keys]
+            route.fallback = fallback
+            route.model, route.tagfields, route.countfields = None, None, None
+            if fieldname is not None:
+                route.model = model
+                route.tagfields = tagfields
+                route.countfields = tagfields + ['count']
+            byfields[frozenset(fields)] = route
+    return routes
+
+
+def _handler_request_finished(signal, sender, **named):
+    "Flushes the deferred stats buffers at the end of every request."
+    stats.flush_all()
 
 
 def register():
     "Internal function to register all known signals"
     models.signals.class_prepared.connect(_handler_tagged_subclass)
     models.signals.pre_delete.connect(_handler_obj_delete)
+    request_finished.connect(_handler_request_finished)
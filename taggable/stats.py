@@ -0,0 +1,677 @@
+"Taggable stats tables maintenance"
+
+import operator
+import random
+import sys
+import threading
+import time
+
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.fields import AutoField
+try:
+    # django 1.2+
+    from django.db import DEFAULT_DB_ALIAS, connections, router
+except ImportError:
+    # django 1.1
+    DEFAULT_DB_ALIAS, connections, router = None, None, None
+
+
+# max number of keys/rows sent to the database in a single statement
+CHUNK_SIZE = 500
+
+# buffers of the tagged models that use deferred stats
+_buffers = []
+
+# cached results of the native upsert support check, by database alias
+_upsert_vendor = {}
+
+
+def db_for_write(model, using=None):
+    """Returns the database alias used to write to a model's table.
+
+    ``using`` when given, else the database routers' choice (always None on
+    django 1.1, that has a single database).
+    """
+    if using is None and router is not None:
+        using = router.db_for_write(model)
+    return using
+
+
+def db_for_read(model):
+    "Returns the database alias used to read a model's table."
+    if router is None:
+        return None
+    return router.db_for_read(model)
+
+
+def instance_db(obj):
+    "Returns the database alias of a saved instance (None on django 1.1)."
+    return getattr(getattr(obj, '_state', None), 'db', None)
+
+
+def get_connection(using=None):
+    "Returns the connection of a database alias."
+    if connections is None:
+        return connection
+    return connections[using or DEFAULT_DB_ALIAS]
+
+
+def get_manager(model, using=None):
+    "Returns the default manager of a model, or a queryset on a database."
+    if using is None:
+        return model.objects
+    return model.objects.using(using)
+
+
+def commit_unless_managed(using=None):
+    "Commits the transaction of a database alias, unless it's managed."
+    if using is None:
+        transaction.commit_unless_managed()
+    else:
+        transaction.commit_unless_managed(using=using)
+
+
+def commit_on_success(using, func, *args):
+    "Calls a function in a transaction of a database alias."
+    if using is None:
+        return transaction.commit_on_success(func)(*args)
+    return transaction.commit_on_success(using=using)(func)(*args)
+
+
+def field_value(value):
+    "Returns the primary key of a model instance, or the value itself."
+    return getattr(value, 'pk', value)
+
+
+def chunked(seq, size=CHUNK_SIZE):
+    "Yields successive lists of at most ``size`` elements from seq."
+    chunk = []
+    for item in seq:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def keys_q(keys, keyvals):
+    "Returns a Q object that matches a list of keys of a stats table."
+    if len(keys) == 1:
+        return Q(**{'%s__in' % keys[0]: [val[0] for val in keyvals]})
+    return reduce(operator.or_,
+                  [Q(**dict(zip(keys, val))) for val in keyvals])
+
+
+def _prep_save(field, value, conn):
+    try:
+        # django 1.2+
+        return field.get_db_prep_save(value, connection=conn)
+    except TypeError:
+        # django 1.1
+        return field.get_db_prep_save(value)
+
+
+def _insert_sql(model, conn):
+    "Returns the fields and the SQL used to insert rows in a model's table."
+    opts = model._meta
+    fields = [field for field in opts.local_fields
+              if not isinstance(field, AutoField)]
+    qn = conn.ops.quote_name
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        qn(opts.db_table),
+        ', '.join([qn(field.column) for field in fields]),
+        ', '.join(['%s'] * len(fields)))
+    return fields, sql
+
+
+def _insert_params(fields, objs, conn):
+    return [[_prep_save(field, field.pre_save(obj, True), conn)
+             for field in fields] for obj in objs]
+
+
+def bulk_insert(model, objs, using=None):
+    """Inserts a list of unsaved model instances with a single statement.
+
+    The primary keys of the instances are NOT set. ``using`` is the
+    database alias, see :func:`db_for_write`.
+    """
+    if not objs:
+        return
+    using = db_for_write(model, using)
+    conn = get_connection(using)
+    fields, sql = _insert_sql(model, conn)
+    cursor = conn.cursor()
+    cursor.executemany(sql, _insert_params(fields, objs, conn))
+    commit_unless_managed(using)
+
+
+def raw_delete(model, fieldname, values, using=None):
+    """Deletes the rows of a model with a field in a list of values.
+
+    The rows aren't loaded and no signals are sent. One statement per
+    chunk of values, on the ``using`` database.
+    """
+    conn = get_connection(db_for_write(model, using))
+    qn = conn.ops.quote_name
+    column = model._meta.get_field(fieldname).column
+    cursor = conn.cursor()
+    for chunk in chunked(values):
+        cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+            qn(model._meta.db_table), qn(column),
+            ', '.join(['%s'] * len(chunk))), chunk)
+
+
+def vendor(using=None):
+    "Returns the name of the database used: postgresql, mysql, sqlite..."
+    module = get_connection(using).__class__.__module__
+    for name, vendor_name in (('postgis', 'postgresql'),
+                              ('postgresql', 'postgresql'),
+                              ('spatialite', 'sqlite'),
+                              ('sqlite', 'sqlite'),
+                              ('mysql', 'mysql')):
+        if name in module:
+            return vendor_name
+    return None
+
+
+def upsert_vendor(using=None):
+    """Returns the vendor name if the database supports native upserts.
+
+    That is INSERT ... ON CONFLICT DO UPDATE for PostgreSQL 9.5+ and
+    SQLite 3.24+, or INSERT ... ON DUPLICATE KEY UPDATE for MySQL.
+    """
+    using = using or DEFAULT_DB_ALIAS
+    if using not in _upsert_vendor:
+        conn = get_connection(using)
+        name = vendor(using)
+        if name == 'sqlite':
+            database = sys.modules[conn.__class__.__module__].Database
+            if database.sqlite_version_info < (3, 24, 0):
+                name = None
+        elif name == 'postgresql':
+            # makes sure we have a connection
+            conn.cursor()
+            if getattr(conn.connection, 'server_version', 0) < 90500:
+                name = None
+        _upsert_vendor[using] = name
+    return _upsert_vendor[using]
+
+
+def _is_unique(model, keys):
+    "Returns True if there is an unique constraint for the keys of a model."
+    opts = model._meta
+    if len(keys) == 1 and opts.get_field(keys[0]).unique:
+        return True
+    return set(keys) in [set(fields) for fields in opts.unique_together]
+
+
+def upsert_sql(statsmodel, keys, using=None):
+    """Returns the fields and the SQL used to add counts to a stats table.
+
+    Returns None if the database doesn't support native upserts, or if the
+    keys of the stats table aren't unique.
+    """
+    name = upsert_vendor(using)
+    if name is None or not _is_unique(statsmodel, keys):
+        return None
+    conn = get_connection(using)
+    fields, sql = _insert_sql(statsmodel, conn)
+    qn = conn.ops.quote_name
+    count = qn(statsmodel._meta.get_field('count').column)
+    if name == 'mysql':
+        sql += ' ON DUPLICATE KEY UPDATE %s = %s + VALUES(%s)' % (
+            count, count, count)
+    else:
+        sql += ' ON CONFLICT (%s) DO UPDATE SET %s = %s.%s + EXCLUDED.%s' % (
+            ', '.join([qn(statsmodel._meta.get_field(key).column)
+                       for key in keys]),
+            count, qn(statsmodel._meta.db_table), count, count)
+    return fields, sql
+
+
+def tagged_row(tagged):
+    "Returns a dict of tagged field names and the raw values of a tagged obj."
+    return dict([(name, getattr(tagged, attname))
+                 for name, attname in tagged.taggable_attnames.items()])
+
+
+def stats_deltas(cls, rows, sign=1):
+    """Aggregates a list of tagged rows into count deltas.
+
+    Returns a dict with the stats fields of every stats table as keys, and
+    dicts of {stats key values: delta} as values.
+    """
+    deltas = {}
+    for keys in cls.taggable_stats:
+        kdeltas = deltas[keys] = {}
+        for row in rows:
+            val = tuple([row[key] for key in keys])
+            kdeltas[val] = kdeltas.get(val, 0) + sign
+    return deltas
+
+
+def _increment(statsmodel, keys, delta, keyvals, using):
+    "Increments the count of existing keys, returns the missing keys."
+    missing = []
+    for chunk in chunked(keyvals):
+        qset = get_manager(statsmodel, using).filter(keys_q(keys, chunk))
+        updated_rows = qset.update(count=F('count') + delta)
+        if updated_rows == len(chunk):
+            continue
+        if updated_rows == 0:
+            existing = set()
+        else:
+            existing = set(qset.values_list(*keys))
+        missing.extend([val for val in chunk if val not in existing])
+    return missing
+
+
+def _decrement(statsmodel, keys, delta, keyvals, using):
+    "Decrements the count of keys, removing the ones that reach zero."
+    for chunk in chunked(keyvals):
+        qset = get_manager(statsmodel, using).filter(keys_q(keys, chunk))
+        qset.filter(count__lte=delta).delete()
+        qset.filter(count__gt=delta).update(count=F('count') - delta)
+
+
+def _stats_objs(statsmodel, keys, deltas):
+    "Returns unsaved stats objects for a list of (key values, count)."
+    attnames = [statsmodel._meta.get_field(key).attname for key in keys]
+    objs = []
+    for val, delta in deltas:
+        qdict = dict(zip(attnames, val))
+        qdict['count'] = delta
+        objs.append(statsmodel(**qdict))
+    return objs
+
+
+def _upsert(statsmodel, keys, incs, using):
+    """Adds counts to a stats table using the database's native upsert.
+
+    Returns False if native upserts can't be used.
+    """
+    upsert = upsert_sql(statsmodel, keys, using)
+    if upsert is None:
+        return False
+    fields, sql = upsert
+    # sorted, to always lock the rows in the same order
+    incs.sort()
+    conn = get_connection(using)
+    cursor = conn.cursor()
+    for chunk in chunked(incs):
+        cursor.executemany(sql, _insert_params(fields,
+            _stats_objs(statsmodel, keys, chunk), conn))
+    commit_unless_managed(using)
+    return True
+
+
+def _shard_counts(statsmodel, keys, keyvals, using):
+    "Returns a dict with the [(shard, count)] of a list of key values."
+    counts = {}
+    for chunk in chunked(keyvals):
+        for row in get_manager(statsmodel, using).filter(
+                keys_q(keys, chunk)).values_list(
+                *(keys + ('shard', 'count'))):
+            counts.setdefault(tuple(row[:-2]), []).append(row[-2:])
+    return counts
+
+
+def shard_deltas(statsmodel, keys, deltas, using=None):
+    """Spreads count deltas over the shards of a sharded stats table.
+
+    Every increment goes to a random shard, so concurrent writes of the same
+    key don't wait for each other. Decrements are taken from the existing
+    shards of the key, the biggest first (one query per chunk of keys).
+    Returns the keys (with ``shard``) and deltas to apply.
+    """
+    shards = statsmodel.taggable_shards
+    sharded = {}
+    existing = _shard_counts(statsmodel, keys,
+                             [val for val, delta in deltas.items()
+                              if delta < 0], using)
+    for val, delta in deltas.items():
+        if delta > 0:
+            sharded[val + (random.randrange(shards), )] = delta
+            continue
+        left = -delta
+        for shard, count in sorted(existing.get(val, []),
+                                   key=lambda sc: -sc[1]):
+            if not left:
+                break
+            sharded[val + (shard, )] = -min(left, count)
+            left -= min(left, count)
+    return keys + ('shard', ), sharded
+
+
+def apply_deltas(statsmodel, keys, deltas, using=None):
+    """Applies a dict of {key values: delta} to a stats table.
+
+    Increments use a single native upsert when the database supports it.
+    Otherwise keys that share the same delta are updated with a single
+    statement, and missing keys are created with a single insert.
+    The deltas of sharded stats tables are spread over their shards first,
+    see :func:`shard_deltas`. ``using`` is the database alias, see
+    :func:`db_for_write`.
+    """
+    using = db_for_write(statsmodel, using)
+    if getattr(statsmodel, 'taggable_shards', 0):
+        keys, deltas = shard_deltas(statsmodel, keys, deltas, using)
+    _apply_deltas(statsmodel, keys, deltas, using)
+
+
+def _apply_deltas(statsmodel, keys, deltas, using):
+    incs, decs = [], {}
+    for val, delta in deltas.items():
+        if delta > 0:
+            incs.append((val, delta))
+        elif delta < 0:
+            decs.setdefault(-delta, []).append(val)
+    if incs and not _upsert(statsmodel, keys, incs, using):
+        bydelta = {}
+        for val, delta in incs:
+            bydelta.setdefault(delta, []).append(val)
+        missing = []
+        for delta, keyvals in bydelta.items():
+            missing.extend([(val, delta) for val in
+                            _increment(statsmodel, keys, delta, keyvals,
+                                       using)])
+        bulk_insert(statsmodel, _stats_objs(statsmodel, keys, missing),
+                    using)
+    for delta, keyvals in decs.items():
+        _decrement(statsmodel, keys, delta, keyvals, using)
+
+
+def compact_stats(cls, keys):
+    """Folds the shards of a sharded stats table into the shard 0.
+
+    The counts of the other shards are moved with relative updates, so
+    concurrent writes aren't lost. One transaction per chunk of rows.
+    Returns the number of folded rows.
+    """
+    statsmodel = cls.taggable_stats[keys]
+    if not getattr(statsmodel, 'taggable_shards', 0):
+        return 0
+    using = db_for_write(statsmodel)
+    rows = list(get_manager(statsmodel, using).exclude(
+        shard=0).values_list(*(keys + ('shard', 'count'))))
+    for chunk in chunked(rows):
+        commit_on_success(using, _fold_shards, statsmodel, keys, chunk,
+                          using)
+    return len(rows)
+
+
+def _fold_shards(statsmodel, keys, rows, using):
+    deltas = {}
+    for row in rows:
+        val, shard, count = tuple(row[:-2]), row[-2], row[-1]
+        deltas[val + (shard, )] = -count
+        deltas[val + (0, )] = deltas.get(val + (0, ), 0) + count
+    _apply_deltas(statsmodel, keys + ('shard', ), deltas, using)
+
+
+def _key_ordering(model, keys, using):
+    "Returns an extra() ordering by the key columns, without joins."
+    qn = get_connection(using).ops.quote_name
+    return ['%s.%s' % (model._meta.db_table,
+                       qn(model._meta.get_field(key).column))
+            for key in keys]
+
+
+def _after_q(keys, val):
+    "Returns a Q object that matches the keys sorted after ``val``."
+    q = None
+    for i, key in enumerate(keys):
+        keyq = Q(**dict(zip(keys[:i], val[:i]) +
+                        [('%s__gt' % key, val[i])]))
+        q = keyq if q is None else q | keyq
+    return q
+
+
+def sorted_groups(qset, model, keys, chunk_size=CHUNK_SIZE):
+    """Iterates over the rows of a values_list() queryset sorted by keys.
+
+    Every chunk of ``chunk_size`` rows is read with its own query, starting
+    after the keys of the previous chunk (keyset pagination), so neither
+    the process nor the database driver holds the whole result (with
+    client side cursors, ``iterator()`` still fetches it all).
+    """
+    qset = qset.extra(order_by=_key_ordering(model, keys,
+                                             getattr(qset, 'db', None)))
+    chunk = qset
+    while True:
+        rows = list(chunk[:chunk_size])
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            break
+        chunk = qset.filter(_after_q(keys, rows[-1][:len(keys)]))
+
+
+def stats_diff(cls, keys, chunk_size=CHUNK_SIZE, using=None):
+    """Compares a stats table with the tagged table.
+
+    Streams one GROUP BY query over the tagged table and the stats table,
+    both sorted by key (see :func:`sorted_groups`), and merges them.
+    Yields ``(key values, expected count, stored count)`` tuples for every
+    key with a wrong count.
+    """
+    statsmodel = cls.taggable_stats[keys]
+    expected = sorted_groups(get_manager(cls, using).values_list(
+        *keys).annotate(taggable_count=Count('pk')), cls, keys, chunk_size)
+    stored = get_manager(statsmodel, using)
+    if getattr(statsmodel, 'taggable_shards', 0):
+        stored = stored.values_list(*keys).annotate(
+            taggable_count=Sum('count'))
+    else:
+        stored = stored.values_list(*(keys + ('count', )))
+    stored = sorted_groups(stored, statsmodel, keys, chunk_size)
+    exp, sto = next(expected, None), next(stored, None)
+    while exp is not None or sto is not None:
+        if sto is None or (exp is not None and exp[:-1] < sto[:-1]):
+            yield tuple(exp[:-1]), exp[-1], 0
+            exp = next(expected, None)
+        elif exp is None or sto[:-1] < exp[:-1]:
+            yield tuple(sto[:-1]), 0, sto[-1]
+            sto = next(stored, None)
+        else:
+            if exp[-1] != sto[-1]:
+                yield tuple(exp[:-1]), exp[-1], sto[-1]
+            exp, sto = next(expected, None), next(stored, None)
+
+
+def _set_counts(statsmodel, keys, counts, using):
+    "Sets the count of a list of existing (key values, count) in bulk."
+    conn = get_connection(using)
+    qn = conn.ops.quote_name
+    opts = statsmodel._meta
+    sql = 'UPDATE %s SET %s = %%s WHERE %s' % (
+        qn(opts.db_table), qn(opts.get_field('count').column),
+        ' AND '.join(['%s = %%s' % qn(opts.get_field(key).column)
+                      for key in keys]))
+    cursor = conn.cursor()
+    for chunk in chunked(counts):
+        cursor.executemany(sql, [[count] + list(val)
+                                 for val, count in chunk])
+
+
+def rebuild_stats(cls, keys, dry_run=False, callback=None,
+                  chunk_size=CHUNK_SIZE):
+    """Recomputes a stats table from the tagged table.
+
+    ``callback(statsmodel, key values, expected, stored)`` is called for
+    every wrong key. When ``dry_run`` is True nothing is written, otherwise
+    the wrong keys are fixed with bulk writes in a single transaction, every
+    ``chunk_size`` wrong keys as they are found, so the memory used doesn't
+    depend on the size of the tables.
+    Returns the number of wrong keys.
+    """
+    statsmodel = cls.taggable_stats[keys]
+    if dry_run:
+        mismatches = 0
+        for val, expected, stored in stats_diff(cls, keys, chunk_size):
+            mismatches += 1
+            if callback is not None:
+                callback(statsmodel, val, expected, stored)
+        return mismatches
+    using = db_for_write(statsmodel)
+    return commit_on_success(using, _rebuild, cls, keys, callback,
+                             chunk_size, using)
+
+
+def _rebuild(cls, keys, callback, chunk_size, using):
+    statsmodel = cls.taggable_stats[keys]
+    mismatches = 0
+    for chunk in chunked(stats_diff(cls, keys, chunk_size, using),
+                         chunk_size):
+        missing, wrong, extra = [], [], []
+        for val, expected, stored in chunk:
+            if callback is not None:
+                callback(statsmodel, val, expected, stored)
+            if not stored:
+                missing.append((val, expected))
+            elif not expected:
+                extra.append(val)
+            elif getattr(statsmodel, 'taggable_shards', 0):
+                # the shards are replaced by a single row
+                extra.append(val)
+                missing.append((val, expected))
+            else:
+                wrong.append((val, expected))
+        # the written keys were already read by stats_diff()
+        _write_rebuild(statsmodel, keys, missing, wrong, extra, using)
+        _invalidate_counts(cls, keys, [val for val, _, _ in chunk])
+        mismatches += len(chunk)
+    return mismatches
+
+
+def _write_rebuild(statsmodel, keys, missing, wrong, extra, using):
+    for chunk in chunked(extra):
+        get_manager(statsmodel, using).filter(keys_q(keys, chunk)).delete()
+    _set_counts(statsmodel, keys, wrong, using)
+    for chunk in chunked(missing):
+        bulk_insert(statsmodel, _stats_objs(statsmodel, keys, chunk), using)
+
+
+def queryset_deltas(qset, sign=-1, exclude=()):
+    """Aggregates the rows of a tagged queryset into count deltas.
+
+    Uses one GROUP BY query per stats table (but the ``exclude`` keys),
+    returns the same structure as :func:`stats_deltas`.
+    """
+    deltas = {}
+    for keys in qset.model.taggable_stats:
+        if keys in exclude:
+            continue
+        grouped = qset.values_list(*keys).annotate(
+            taggable_count=Count('pk')).order_by()
+        deltas[keys] = dict([(tuple(row[:-1]), sign * row[-1])
+                             for row in grouped])
+    return deltas
+
+
+def _merge_deltas(dest, deltas):
+    "Merges deltas into dest, returns the number of new keys in dest."
+    added = 0
+    for keys, kdeltas in deltas.items():
+        dkdeltas = dest.setdefault(keys, {})
+        for val, delta in kdeltas.items():
+            if val not in dkdeltas:
+                added += 1
+                dkdeltas[val] = delta
+            else:
+                dkdeltas[val] += delta
+    return added
+
+
+class StatsBuffer(object):
+    """In-process buffer of stats deltas, used by the deferred stats mode.
+
+    Deltas are coalesced by database and stats key, and written to the
+    stats tables when the buffer holds ``size`` keys, when ``interval``
+    seconds passed since the last flush, at the end of every request, or
+    when calling :meth:`flush`. The stats tables are eventually consistent.
+    """
+
+    def __init__(self, cls, size, interval):
+        self.cls = cls
+        self.size = size
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.deltas = {}
+        self.entries = 0
+        self.last_flush = time.time()
+
+    def add(self, deltas, using=None):
+        "Adds deltas to the buffer, flushing it if needed."
+        self.lock.acquire()
+        try:
+            self.entries += _merge_deltas(self.deltas, dict([
+                ((using, keys), kdeltas)
+                for keys, kdeltas in deltas.items()]))
+            due = (self.entries >= self.size or
+                   time.time() - self.last_flush >= self.interval)
+        finally:
+            self.lock.release()
+        if due:
+            self.flush()
+
+    def flush(self):
+        "Writes the buffered deltas to the stats tables."
+        self.lock.acquire()
+        try:
+            deltas, self.deltas = self.deltas, {}
+            self.entries = 0
+            self.last_flush = time.time()
+        finally:
+            self.lock.release()
+        pending = deltas.items()
+        try:
+            while pending:
+                (using, keys), kdeltas = pending[0]
+                apply_deltas(self.cls.taggable_stats[keys], keys, kdeltas,
+                             using)
+                _invalidate_counts(self.cls, keys, kdeltas.keys())
+                pending.pop(0)
+        except IntegrityError:
+            # the deltas of a stats table reference deleted objects: they
+            # would fail again, so they're dropped (rebuild_stats() fixes
+            # the table)
+            self._keep(pending[1:])
+            raise
+        except:
+            self._keep(pending)
+            raise
+
+    def _keep(self, pending):
+        "Buffers again the deltas that couldn't be written."
+        self.lock.acquire()
+        try:
+            self.entries += _merge_deltas(self.deltas, dict(pending))
+        finally:
+            self.lock.release()
+
+
+def _invalidate_counts(cls, keys, keyvals):
+    "Removes the cached counts that are read from a stats table."
+    if cls.taggable_count_cache is not None:
+        from taggable import caching
+
+        caching.invalidate_keys(cls, keys, keyvals)
+
+
+def flush_all():
+    "Flushes the stats buffers of all the tagged models."
+    for buf in _buffers:
+        buf.flush()
+
+
+def update_stats(cls, deltas, using=None):
+    "Applies (or buffers) the deltas of every stats table of a tagged model."
+    if cls.taggable_stats_buffer is not None:
+        cls.taggable_stats_buffer.add(deltas, using)
+        return
+    for keys, kdeltas in deltas.items():
+        apply_deltas(cls.taggable_stats[keys], keys, kdeltas, using)
+
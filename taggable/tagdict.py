@@ -0,0 +1,123 @@
+"Taggable tag dictionaries, process local caches of tag names to pks"
+
+import threading
+import time
+
+from taggable import stats
+
+
+# the dictionaries of every tag model and name field
+_dictionaries = {}
+
+
+class TagDictionary(object):
+    """LRU cache of the primary keys of the tags of a model, by name.
+
+    ``size`` is the maximum number of names, and ``ttl`` the seconds a name
+    is kept (names are only removed automatically when tags are deleted,
+    so the ttl limits how long a renamed tag is found by its old name).
+    """
+
+    def __init__(self, model, field, size, ttl):
+        self.model = model
+        self.field = field
+        self.size = size
+        self.ttl = ttl
+        # {name: [pk, expiration time, last use]}
+        self.entries = {}
+        self.uses = 0
+        self.lock = threading.Lock()
+
+    def _get(self, names, now):
+        "Returns the cached pks of a list of names, as a dict."
+        found = {}
+        self.lock.acquire()
+        try:
+            for name in names:
+                entry = self.entries.get(name)
+                if entry is None:
+                    continue
+                if entry[1] < now:
+                    del self.entries[name]
+                    continue
+                self.uses += 1
+                entry[2] = self.uses
+                found[name] = entry[0]
+        finally:
+            self.lock.release()
+        return found
+
+    def _set(self, pks, now):
+        "Adds a dict of {name: pk}, evicting the least recently used names."
+        self.lock.acquire()
+        try:
+            for name, pk in pks.items():
+                self.uses += 1
+                self.entries[name] = [pk, now + self.ttl, self.uses]
+            if len(self.entries) > self.size:
+                # evicts a tenth of the names at once, so the sort is rare
+                keep = self.size - self.size // 10
+                byuse = sorted(self.entries.items(),
+                               key=lambda item: item[1][2])
+                for name, _ in byuse[:len(byuse) - keep]:
+                    del self.entries[name]
+        finally:
+            self.lock.release()
+
+    def _fetch(self, names):
+        "Reads the pks of a list of names, one query per chunk."
+        pks = {}
+        for chunk in stats.chunked(names):
+            pks.update(self.model.objects.filter(
+                **{'%s__in' % self.field: chunk}).values_list(self.field,
+                                                              'pk'))
+        return pks
+
+    def lookup(self, names, create=True):
+        """Returns a dict with the primary keys of a list of tag names.
+
+        The names that aren't cached are read with one query per chunk,
+        and with ``create`` the missing tags are inserted with a single
+        statement. Without ``create``, unknown names are not in the dict.
+        """
+        now = time.time()
+        names = set(names)
+        pks = self._get(names, now)
+        missing = names.difference(pks)
+        if missing:
+            fetched = self._fetch(missing)
+            missing.difference_update(fetched)
+            if missing and create:
+                stats.bulk_insert(self.model, [
+                    self.model(**{self.field: name}) for name in missing])
+                fetched.update(self._fetch(missing))
+            self._set(fetched, now)
+            pks.update(fetched)
+        return pks
+
+    def discard(self, tag):
+        "Removes a tag from the dictionary."
+        self.lock.acquire()
+        try:
+            self.entries.pop(getattr(tag, self.field), None)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+        finally:
+            self.lock.release()
+
+
+def get_dictionary(model, field, size, ttl):
+    """Returns the dictionary of a tag model and name field.
+
+    Tagged models with the same tags share it, the first one sets the size
+    and ttl.
+    """
+    key = (model, field)
+    if key not in _dictionaries:
+        _dictionaries[key] = TagDictionary(model, field, size, ttl)
+    return _dictionaries[key]
@@ -0,0 +1,73 @@
+"""Taggable tag lists
+
+A tagged model with ``Taggable.tag_list = (fieldname, attname)`` keeps the
+sorted tag names of every object of ``fieldname`` serialized in the
+``attname`` text field of the object, so showing the tags of an object
+doesn't need a query. ``Taggable.tag_list_name`` is the tag field stored
+in the list, ``name`` by default.
+"""
+
+from django.utils import simplejson
+from taggable import stats
+
+
+def dumps(names):
+    "Serializes a list of tag names."
+    return simplejson.dumps(sorted(names), separators=(',', ':'))
+
+
+def loads(value):
+    "Returns the tag names of a serialized tag list."
+    if not value:
+        return []
+    return simplejson.loads(value)
+
+
+def refresh(cls, pks, using=None):
+    """Rewrites the tag lists of a list of objects from the tagged table.
+
+    The tag names of every chunk of objects are read with a single query,
+    and the objects with the same tags are updated with a single statement,
+    on the ``using`` database if given.
+    """
+    fieldname, attname = cls.taggable_tag_list
+    model = cls._meta.get_field(fieldname).rel.to
+    namefield = 'tag__%s' % cls.taggable_tag_list_name
+    pks = set([stats.field_value(pk) for pk in pks])
+    for chunk in stats.chunked(pks):
+        names = dict([(pk, set()) for pk in chunk])
+        for pk, name in stats.get_manager(cls, using).filter(**{
+                '%s__in' % fieldname: chunk}).values_list(
+                fieldname, namefield).order_by():
+            names[pk].add(name)
+        byvalue = {}
+        for pk, tagnames in names.items():
+            byvalue.setdefault(dumps(tagnames), []).append(pk)
+        for value, objpks in byvalue.items():
+            stats.get_manager(model, using).filter(pk__in=objpks).update(
+                **{attname: value})
+
+
+def rows_changed(cls, rows, using=None):
+    "Refreshes the tag lists of the objects of a list of tagged rows."
+    refresh(cls, [row[cls.taggable_tag_list[0]] for row in rows], using)
+
+
+def rebuild(cls, chunk_size=stats.CHUNK_SIZE):
+    """Rewrites the tag lists of all the objects, in chunks.
+
+    Returns the number of objects.
+    """
+    model = cls._meta.get_field(cls.taggable_tag_list[0]).rel.to
+    qset = model.objects.order_by('pk').values_list('pk', flat=True)
+    total, last = 0, None
+    while True:
+        if last is None:
+            pks = list(qset[:chunk_size])
+        else:
+            pks = list(qset.filter(pk__gt=last)[:chunk_size])
+        if not pks:
+            return total
+        refresh(cls, pks)
+        total += len(pks)
+        last = pks[-1]
@@ -1,15 +1,21 @@
 "Taggable unit/functional tests"
 
 import functools
+import random
 
+from django.core.exceptions import ImproperlyConfigured
 from django.test import TestCase
-from django.db import models, transaction
+from django.db import IntegrityError, models, transaction
 from taggable.models import Tagged
-from taggable.exceptions import InvalidFields
+from taggable import benchmarks, caching, instrumentation, planner, stats, \
+    tagdict
+from taggable.querysets import assign_weights, encode_cursor
+from taggable.exceptions import InvalidCursor, InvalidFields
 
 
 class Monster(models.Model):
     name = models.CharField(max_length=100)
+    simple_tags = models.TextField(blank=True)
 
     def __unicode__(self):  # pragma: no cover
         return self.name
@@ -41,6 +47,15 @@ class SimpleStats(models.Model):
     count = models.PositiveIntegerField(default=0)
 
 
+class SimpleCooc(models.Model):
+    tag_a = models.ForeignKey(Tag, related_name='simplecooc_a')
+    tag_b = models.ForeignKey(Tag, related_name='simplecooc_b')
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = (('tag_a', 'tag_b'), )
+
+
 class SimpleTagged(Tagged):
     tag = models.ForeignKey(Tag)
     monster = models.ForeignKey(Monster)
@@ -55,6 +70,9 @@ class SimpleTagged(Tagged):
         stats = {
             ('tag', ): SimpleStats,
         }
+        cooccurrence = SimpleCooc
+        tag_dictionary = 'name'
+        tag_list = ('monster', 'simple_tags')
 
 
 class SimpleTaggedNoStats(Tagged):
@@ -67,6 +85,29 @@ class SimpleTaggedNoStats(Tagged):
     class Meta:
         unique_together = (('tag', 'monster'), )
 
+    class Taggable:
+        tag_dictionary = 'name'
+
+
+class DeferredStats(models.Model):
+    tag = models.ForeignKey(Tag, primary_key=True)
+    count = models.PositiveIntegerField(default=0)
+
+
+class DeferredTagged(Tagged):
+    tag = models.ForeignKey(Tag)
+    monster = models.ForeignKey(Monster)
+
+    class Meta:
+        unique_together = (('tag', 'monster'), )
+
+    class Taggable:
+        stats = {
+            ('tag', ): DeferredStats,
+        }
+        stats_deferred = True
+        stats_flush_interval = 3600
+
 
 class StatsTag(models.Model):
     tag = models.ForeignKey(Tag, unique=True)
@@ -92,6 +133,15 @@ class StatsTagUsrCat(models.Model):
         unique_together = (('tag', 'user', 'category'), )
 
 
+class ComplexCooc(models.Model):
+    tag_a = models.ForeignKey(Tag, related_name='complexcooc_a')
+    tag_b = models.ForeignKey(Tag, related_name='complexcooc_b')
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = (('tag_a', 'tag_b'), )
+
+
 class ComplexTagged(Tagged):
     tag = models.ForeignKey(Tag)
     user = models.ForeignKey(User)
@@ -111,6 +161,8 @@ class ComplexTagged(Tagged):
             ('tag', 'user'): StatsTagUsr,
             ('tag', 'user', 'category'): StatsTagUsrCat,
         }
+        count_cache = 'locmem://'
+        cooccurrence = ComplexCooc
 
 
 class ComplexTaggedNoStats(Tagged):
@@ -127,6 +179,40 @@ class ComplexTaggedNoStats(Tagged):
         unique_together = (('tag', 'user', 'category', 'monster'), )
 
 
+class ShardedStatsTag(models.Model):
+    tag = models.ForeignKey(Tag, unique=True)
+    count = models.PositiveIntegerField(default=0)
+
+
+class ShardedStatsTagUsr(models.Model):
+    tag = models.ForeignKey(Tag)
+    user = models.ForeignKey(User)
+    shard = models.PositiveSmallIntegerField(default=0)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = (('tag', 'user', 'shard'), )
+
+
+class ShardedTagged(Tagged):
+    tag = models.ForeignKey(Tag)
+    user = models.ForeignKey(User)
+    category = models.ForeignKey(Category)
+    monster = models.ForeignKey(Monster)
+
+    class Meta:
+        unique_together = (('tag', 'user', 'category', 'monster'), )
+
+    class Taggable:
+        stats = {
+            ('tag', ): ShardedStatsTag,
+            ('tag', 'user'): ShardedStatsTagUsr,
+        }
+        stats_shards = {
+            ('tag', 'user'): 4,
+        }
+
+
 def testtype(tagtype='simple', stats=False):
 
     def decorator(f):
@@ -142,6 +228,16 @@ def testtype(tagtype='simple', stats=False):
                 f(self)
             finally:
                 transaction.rollback()
+                if self.taggedmodel.taggable_count_cache is not None:
+                    # a new locmem backend is empty (django 1.1 backends
+                    # have no clear())
+                    self.taggedmodel.taggable_count_cache = \
+                        caching.get_backend(
+                            self.taggedmodel.Taggable.count_cache)
+                if self.taggedmodel.taggable_tagdict is not None:
+                    # the cached pks may have been rolled back
+                    self.taggedmodel.taggable_tagdict.clear()
+                self.taggedmodel.taggable_autocomplete.clear()
                 self.taggedmodel = None
         return _testtype
     return decorator
@@ -152,9 +248,9 @@ def _load_test_methods(cls):
         is_simple = 'simple' in m
         if not m.startswith('_simple_') and not m.startswith('_complex_'):
             continue
-        for stats in (False, True):
-            deco = testtype('simple' if is_simple else 'complex', stats)
-            name = 'test_%s%s' % ('stats' if stats else 'nostats', m)
+        for withstats in (False, True):
+            deco = testtype('simple' if is_simple else 'complex', withstats)
+            name = 'test_%s%s' % ('stats' if withstats else 'nostats', m)
             setattr(cls, name, deco(getattr(cls, m)))
 
 
@@ -176,6 +272,43 @@ class TestBase(TestCase):
         self.assertEqual(l[7], tm.tag_count(tag=tag, user=user,
                                         category=category))
 
+    def related_helper(self):
+        "Compares related_tags() with the co-occurrences of the rows."
+        tm = self.taggedmodel
+        entityfields = sorted(tm.taggable_taggedfields_notag)
+        entities = {}
+        for row in tm.objects.values_list(*entityfields + ['tag']):
+            entities.setdefault(row[:-1], set()).add(row[-1])
+        for tag in Tag.objects.all():
+            expected = {}
+            for tags in entities.values():
+                if tag.pk in tags:
+                    for other in tags - set([tag.pk]):
+                        expected[other] = expected.get(other, 0) + 1
+            expected = sorted(expected.items(),
+                              key=lambda x: (-x[1], x[0]))
+            self.assertEqual(expected,
+                [(t.pk, t.count) for t in tm.related_tags(tag)])
+            self.assertEqual(expected[:2],
+                [(t.id, t.count) for t in tm.related_tags(tag.pk, top=2,
+                                                          lightweight=True)])
+
+    def tagged_with_helper(self, qset, fieldname, tagnames):
+        "Compares tagged_with_all/any() with the rows of a queryset."
+        tags = list(Tag.objects.filter(name__in=tagnames))
+        byobj = {}
+        for name, tag in qset.values_list('%s__name' % fieldname,
+                                          'tag__name'):
+            if tag in tagnames:
+                byobj.setdefault(name, set()).add(tag)
+        self.assertEqual(sorted(byobj.keys()),
+            list(qset.tagged_with_any(tags, fieldname).order_by(
+                'name').values_list('name', flat=True)))
+        self.assertEqual(sorted([name for name, objtags in byobj.items()
+                                 if len(objtags) == len(tags)]),
+            list(qset.tagged_with_all(tags, fieldname).order_by(
+                'name').values_list('name', flat=True)))
+
     def get_tags_helper(self, tested, expected, partial_tresh, empty_tresh,
                         **kwargs):
         self.assertEqual(expected,
@@ -195,6 +328,14 @@ class TestBase(TestCase):
                  qfilter=lambda q:
                      q.order_by('tag__name').filter(count__gte=empty_tresh),
                  **kwargs)])
+        self.assertEqual(expected,
+            [(t.name, t.count) for t in
+             tested.get_tags(counts=True, lightweight=True,
+                             qfilter=lambda q: q.order_by('tag__name'),
+                             **kwargs)])
+        self.assertEqual([(t[0], None) for t in expected],
+            sorted([(t.name, t.count) for t in
+                    tested.get_tags(lightweight=True, **kwargs)]))
         self.assertEqual([t[0] for t in expected],
             sorted([t.name for t in tested.get_tags(**kwargs)]))
         self.assertEqual([t[0] for t in expected],
@@ -202,6 +343,23 @@ class TestBase(TestCase):
              tested.get_tags(qfilter=lambda q: q.order_by('tag__name'),
                              **kwargs)])
 
+        self.assertEqual([t for t in expected if t[1] >= partial_tresh],
+            sorted([(t.name, t.count) for t in
+                    tested.get_tags(min_count=partial_tresh, **kwargs)]))
+        top = [(t.name, t.count) for t in tested.get_tags(top=3, **kwargs)]
+        self.assertEqual(min(3, len(expected)), len(top))
+        self.assertEqual(sorted([t[1] for t in expected], reverse=True)[:3],
+                         [t[1] for t in top])
+        weights = dict([(t.name, t.weight) for t in
+                        tested.get_tags(buckets=4, lightweight=True,
+                                        **kwargs)])
+        self.assertEqual([t[0] for t in expected], sorted(weights.keys()))
+        for name, count in expected:
+            self.assert_(1 <= weights[name] <= 4)
+            if count == max([t[1] for t in expected]):
+                self.assertEqual(4 if weights[name] > 1 else 1,
+                                 weights[name])
+
         # now sorted the expected values by [-count, +tag__name]
         expected.sort(cmp=lambda x, y:
                                  y[1] - x[1]
@@ -258,10 +416,49 @@ class TestEmpty(TestBase):
         self.cplxtest(user, category, tag,
             (1, 1, 1, 1, 1, 1, 1, 1))
 
+    def benchmark_helper(self):
+        tm = self.taggedmodel
+        ntags = Tag.objects.count()
+        results = benchmarks.run([tm], [200], repeat=2)
+        self.assertEqual(['add_tags_bulk'] + [op for op, _ in
+                                               benchmarks.OPERATIONS],
+                         [result['operation'] for result in results])
+        populated = results[0]
+        self.assertEqual((1, 200), (populated['calls'], populated['size']))
+        for result in results[1:]:
+            self.assertEqual(2, result['calls'])
+            self.assert_(result['queries'] >= 0)
+        # the generated data is deleted
+        self.assertEqual(0, tm.objects.count())
+        self.assertEqual(ntags, Tag.objects.count())
+        report = benchmarks.report(results)
+        self.assertEqual(len(results),
+                         len(benchmarks.compare(report, report)))
+        # the objects are named with their first text field
+        self.assertEqual('name', benchmarks.name_field(Tag).name)
+        # stats rows can't be generated, their tag has no default
+        self.assertEqual(None, benchmarks.name_field(StatsTag))
+
+    def _simple_benchmark(self):
+        self.benchmark_helper()
+
+    def _complex_benchmark(self):
+        self.benchmark_helper()
+
 
 class TestSimple(TestBase):
     fixtures = ['test_objs.json', 'test_tags.json', 'test_simple.json']
 
+    def test_assign_weights(self):
+        tags = [Tag(name=str(count)) for count in (1, 2, 4, 8, 16)]
+        for tag in tags:
+            tag.count = int(tag.name)
+        self.assertEqual([1, 2, 3, 4, 4],
+                         [tag.weight for tag in assign_weights(tags, 4)])
+        self.assertEqual([1], [tag.weight for tag in
+                               assign_weights(tags[2:3], 4)])
+        self.assertEqual([], assign_weights([], 4))
+
     def _simple_delete_single(self):
         tag = Tag.objects.get(name='elemental')
         self.assertEqual(3, self.taggedmodel.tag_count(tag=tag))
@@ -274,6 +471,175 @@ class TestSimple(TestBase):
         Monster.objects.filter(name__in=('Vrock', 'Balor')).delete()
         self.assertEqual(1, self.taggedmodel.tag_count(tag=tag))
 
+    def _simple_delete_using(self):
+        if stats.connections is None:
+            # django 1.1 has a single database
+            return
+        tm = self.taggedmodel
+        tag = Tag.objects.get(name='elemental')
+        vrock = Monster.objects.using(stats.DEFAULT_DB_ALIAS).get(
+            name='Vrock')
+        tm.objects.using(stats.DEFAULT_DB_ALIAS).filter(
+            monster=vrock, tag=tag).delete()
+        self.assertEqual(2, tm.tag_count(tag=tag))
+        tm(monster=vrock, tag=tag).save(using=stats.DEFAULT_DB_ALIAS)
+        self.assertEqual(3, tm.tag_count(tag=tag))
+        tm.purge(monster=vrock)
+        self.assertEqual(2, tm.tag_count(tag=tag))
+
+    def _simple_tag_by_name(self):
+        tm = self.taggedmodel
+        zombie = Monster.objects.get(name='Zombie')
+        vrock = Monster.objects.get(name='Vrock')
+        ntags = Tag.objects.count()
+        tagged = tm.update_tags_by_name(['undead', 'newtag', 'other'],
+                                        monster=zombie)
+        self.assertEqual([u'undead', u'newtag', u'other'],
+                         [t.tag.name for t in tagged])
+        self.assertEqual(ntags + 2, Tag.objects.count())
+        newtag = Tag.objects.get(name='newtag')
+        self.assertEqual(1, tm.tag_count(tag=newtag))
+        # known names need no query
+        counter = instrumentation.Counter()
+        counter.start()
+        try:
+            pks = tm.tag_pks(['undead', 'newtag'])
+        finally:
+            counter.stop()
+        self.assertEqual((0, newtag.pk), (counter.queries, pks['newtag']))
+        tm.add_tag_by_name('newtag', monster=vrock)
+        self.assertEqual(2, tm.tag_count(tag=newtag))
+        self.assertEqual({}, tm.tag_pks(['missing'], create=False))
+        # deleted tags are removed from the dictionary
+        newtag.delete()
+        self.assertEqual({}, tm.tag_pks(['newtag'], create=False))
+        self.assertEqual([u'other', u'undead'], sorted([t.name for t in
+            tm.get_tags(monster=zombie)]))
+
+    def _simple_tag_list(self):
+        tm = self.taggedmodel
+        zombie = Monster.objects.get(name='Zombie')
+        if tm.taggable_tag_list is None:
+            self.assertRaises(ImproperlyConfigured, tm.rebuild_tag_lists)
+            return
+
+        def names(monster):
+            return tm.tag_list(Monster.objects.get(pk=monster.pk))
+
+        self.assertEqual([], names(zombie))
+        self.assertEqual(Monster.objects.count(), tm.rebuild_tag_lists(2))
+        self.assertEqual([u'animate', u'brute', u'lvl2', u'medium',
+                          u'natural', u'undead'], names(zombie))
+        tags = dict([(tag.name, tag) for tag in Tag.objects.all()])
+        tm.update_tags([tags['undead'], tags['brute']], monster=zombie)
+        self.assertEqual([u'brute', u'undead'], names(zombie))
+        tm.add_tag(tags['lvl2'], monster=zombie)
+        self.assertEqual([u'brute', u'lvl2', u'undead'], names(zombie))
+        tm.objects.filter(monster=zombie, tag=tags['brute']).delete()
+        self.assertEqual([u'lvl2', u'undead'], names(zombie))
+        # deleting a tag updates the lists of its objects
+        tags['humanoid'].delete()
+        tags['undead'].delete()
+        self.assertEqual([u'lvl2'], names(zombie))
+        for monster in Monster.objects.all():
+            self.assertEqual(sorted(tm.objects.filter(
+                monster=monster).values_list('tag__name', flat=True)),
+                tm.tag_list(monster))
+
+    def test_deferred_model(self):
+        # a model declared with stats_deferred gets a stats buffer
+        tm = DeferredTagged
+        buf = tm.taggable_stats_buffer
+        self.assert_(isinstance(buf, stats.StatsBuffer))
+        self.assert_(buf in stats._buffers)
+        self.assertEqual((1000, 3600), (buf.size, buf.interval))
+        tag = Tag.objects.get(name='undead')
+        tm.add_tag(tag, monster=Monster.objects.get(name='Zombie'))
+        self.assertEqual(0, DeferredStats.objects.count())
+        self.assertEqual(1, buf.entries)
+        tm.flush_stats()
+        self.assertEqual([(tag.pk, 1)], list(
+            DeferredStats.objects.values_list('tag', 'count')))
+
+    def test_deferred_tagged_with(self):
+        tm = DeferredTagged
+        tags = [Tag.objects.get(name='undead'),
+                Tag.objects.create(name='fresh')]
+        zombie = Monster.objects.get(name='Zombie')
+        for tag in tags:
+            tm.add_tag(tag, monster=zombie)
+        # the stats only order the tags, the buffered rows are found
+        self.assertEqual([zombie], list(tm.objects.all().tagged_with_all(
+            tags, 'monster')))
+        tm.flush_stats()
+        DeferredStats.objects.filter(tag=tags[1]).delete()
+        self.assertEqual([zombie], list(tm.objects.all().tagged_with_all(
+            tags, 'monster')))
+
+    def test_deferred_delete(self):
+        tm = DeferredTagged
+        tag = Tag.objects.get(name='undead')
+        tm.add_tag(tag, monster=Monster.objects.get(name='Zombie'))
+        tm.add_tag(tag, monster=Monster.objects.get(name='Vrock'))
+        self.assertEqual(0, DeferredStats.objects.count())
+        # the deleted rows are counted from the stats deltas
+        events = []
+
+        def receiver(sender, **kwargs):
+            events.append(kwargs['rows'])
+        instrumentation.tagged_operation.connect(receiver)
+        try:
+            tm.objects.filter(tag=tag, monster__name='Vrock').delete()
+        finally:
+            instrumentation.tagged_operation.disconnect(receiver)
+        self.assertEqual([1], events)
+        # the buffered deltas of a deleted object are not written again
+        tag.delete()
+        tm.flush_stats()
+        self.assertEqual([], list(DeferredStats.objects.values_list(
+            'tag', 'count')))
+
+        def failing(error):
+            def apply_deltas(statsmodel, keys, deltas, using=None):
+                raise error
+            return apply_deltas
+
+        buf = tm.taggable_stats_buffer
+        saved = stats.apply_deltas
+        try:
+            for error, kept in ((ValueError(), 1),
+                                (IntegrityError(), 0)):
+                buf.add({('tag', ): {(1, ): 1}})
+                stats.apply_deltas = failing(error)
+                self.assertRaises(type(error), tm.flush_stats)
+                self.assertEqual(kept, buf.entries)
+        finally:
+            stats.apply_deltas = saved
+            buf.deltas, buf.entries = {}, 0
+
+    def test_tag_dictionary(self):
+        dictionary = tagdict.TagDictionary(Tag, 'name', 10, 300)
+        names = ['dict%d' % i for i in range(12)]
+        pks = dictionary.lookup(names)
+        self.assertEqual(12, len(set(pks.values())))
+        # the least recently used names are evicted
+        self.assert_(len(dictionary.entries) <= 10)
+        self.assertEqual(pks[names[-1]], dictionary.entries[names[-1]][0])
+        self.assertEqual(pks, dictionary.lookup(names, create=False))
+        self.assertEqual(12, Tag.objects.filter(name__in=names).count())
+        # expired names are read again
+        dictionary.ttl = -1
+        counter = instrumentation.Counter()
+        counter.start()
+        try:
+            dictionary.lookup(names[:1])
+            dictionary.lookup(names[:1])
+        finally:
+            counter.stop()
+        self.assertEqual(2, counter.queries)
+        self.assertRaises(ImproperlyConfigured, ComplexTagged.tag_pks,
+                          ['dict0'])
+
     def _simple_model_get_tags_one(self):
         monster = Monster.objects.get(name='Zombie')
         expected = [(u'animate', 1), (u'brute', 1), (u'lvl2', 1),
@@ -331,6 +697,24 @@ class TestSimple(TestBase):
             self.taggedmodel.add_tag(tag, monster=monster)
             self.assertEqual(2, self.taggedmodel.tag_count(tag=tag))
 
+    def _simple_add_tags_bulk(self):
+        tags = list(Tag.objects.filter(name__in=['devil', 'tiny']))
+        monsters = list(Monster.objects.all())
+        counts = [self.taggedmodel.tag_count(tag=tag) for tag in tags]
+        rows = [{'tag': tag, 'monster': monster}
+                for tag in tags for monster in monsters]
+        # duplicated rows are only inserted once
+        rows.append({'tag': tags[0].pk, 'monster': monsters[0].pk})
+        created, existing = self.taggedmodel.add_tags_bulk(rows,
+                                                           chunk_size=3)
+        self.assertEqual(len(rows), created + existing)
+        self.assertEqual(sum(counts) + 1, existing)
+        for tag in tags:
+            self.assertEqual(len(monsters),
+                             self.taggedmodel.tag_count(tag=tag))
+        self.assertEqual((0, len(rows)),
+                         self.taggedmodel.add_tags_bulk(rows))
+
     def _simple_add_tag_invalid(self):
         tag = Tag.objects.get(name='devil')
         self.assertRaises(InvalidFields, self.taggedmodel.add_tag,
@@ -369,11 +753,67 @@ class TestSimple(TestBase):
              monster=monster).get_tags(
              qfilter=lambda q: q.order_by('tag__name'))])
 
+    def _simple_update_tags_result(self):
+        monster = Monster.objects.get(name='Zombie')
+        tagnames = ['undead', 'tiny', 'immortal', 'animate']
+        newtags = [Tag.objects.get(name=name) for name in tagnames]
+        counts = [self.taggedmodel.tag_count(tag=tag) for tag in newtags]
+        result = self.taggedmodel.update_tags(newtags, monster=monster)
+        self.assertEqual(tagnames, [tagged.tag.name for tagged in result])
+        self.assertEqual([monster] * 4,
+                         [tagged.monster for tagged in result])
+        self.assertEqual(set([tagged.pk for tagged in result]),
+            set(self.taggedmodel.objects.filter(
+                monster=monster).values_list('pk', flat=True)))
+        self.assertEqual([counts[0], counts[1] + 1, counts[2] + 1,
+                          counts[3]],
+            [self.taggedmodel.tag_count(tag=tag) for tag in newtags])
+
     def _simple_update_tags_invalid(self):
         tags = Tag.objects.filter(name='devil')
         self.assertRaises(InvalidFields, self.taggedmodel.update_tags,
                           tags, invalid=True)
 
+    def _simple_prefetch_tags(self):
+        monsters = self.taggedmodel.objects.prefetch_tags(
+            Monster.objects.all(), 'monster',
+            qfilter=lambda q: q.order_by('tag__name'))
+        for monster in monsters:
+            self.assertEqual(
+                [tag.name for tag in self.taggedmodel.objects.filter(
+                     monster=monster).get_tags(
+                     qfilter=lambda q: q.order_by('tag__name'))],
+                [tag.name for tag in monster.tags])
+        monsters = self.taggedmodel.objects.none().prefetch_tags(
+            Monster.objects.all(), 'monster', attr='tagcache')
+        self.assertEqual([[]] * len(monsters),
+                         [monster.tagcache for monster in monsters])
+
+    def _simple_related_tags(self):
+        self.taggedmodel.rebuild_cooccurrence()
+        self.related_helper()
+        monster = Monster.objects.get(name='Zombie')
+        newtags = Tag.objects.filter(name__in=['brute', 'tiny', 'devil'])
+        self.taggedmodel.update_tags(newtags, monster=monster)
+        self.related_helper()
+        self.taggedmodel.add_tag(Tag.objects.get(name='lvl2'),
+                                 monster=monster)
+        Monster.objects.get(name='Vrock').delete()
+        self.related_helper()
+
+    def _simple_tagged_with(self):
+        tm = self.taggedmodel
+        for tagnames in (['demon'], ['brute', 'humanoid'],
+                         ['elemental', 'large', 'demon'],
+                         ['undead', 'tiny'], ['devil', 'invalid']):
+            self.tagged_with_helper(tm.objects.all(), 'monster', tagnames)
+        self.assertEqual(0,
+            tm.objects.all().tagged_with_all([], 'monster').count())
+        self.assertEqual(0, tm.objects.none().tagged_with_all(
+            Tag.objects.all(), 'monster').count())
+        self.assertEqual(0, tm.objects.none().tagged_with_any(
+            Tag.objects.all(), 'monster').count())
+
     def _simple_get_tagged_related(self):
         expected = [u'Zombie', u'Hezrou']
         qset = self.taggedmodel.objects.filter(monster__name__icontains='z')
@@ -398,6 +838,16 @@ class TestComplex(TestBase):
         self.category = Category.objects.get(name='Demon')
         self.tag = Tag.objects.get(name='humanoid')
 
+    def test_upsert_sql(self):
+        if stats.upsert_vendor() is None:
+            return
+        self.assertNotEqual(None, stats.upsert_sql(StatsTag, ('tag', )))
+        self.assertNotEqual(None, stats.upsert_sql(StatsTagUsrCat,
+                                                   ('category', 'tag',
+                                                    'user')))
+        # the keys must be unique
+        self.assertEqual(None, stats.upsert_sql(StatsTagUsr, ('tag', )))
+
     def _complex_initial_data(self):
         self.cplxtest(self.user, self.category, self.tag,
             (50, 31, 24, 19, 5, 4, 3, 3))
@@ -412,6 +862,239 @@ class TestComplex(TestBase):
         self.cplxtest(self.user, self.category, self.tag,
             (26, 18, 8, 6, 2, 2, 1, 1))
 
+    def _complex_purge(self):
+        tm = self.taggedmodel
+        tm.rebuild_cooccurrence()
+        self.assertEqual(31, tm.purge(user=self.user, chunk_size=4))
+        self.assertEqual(5 - 4, tm.purge(tag=self.tag))
+        self.assertEqual(0, tm.purge(tag=self.tag))
+        self.cplxtest(self.user, self.category, self.tag,
+            (18, 0, tm.objects.filter(category=self.category).count(), 0,
+             0, 0, 0, 0))
+        self.assertEqual(dict([(k, 0) for k in tm.taggable_stats]),
+                         tm.rebuild_stats(dry_run=True))
+        self.assertRaises(InvalidFields, tm.purge, user=self.user,
+                          tag=self.tag)
+        # cascades are purged too
+        User.objects.exclude(pk=self.user.pk)[0].delete()
+        self.assertEqual(dict([(k, 0) for k in tm.taggable_stats]),
+                         tm.rebuild_stats(dry_run=True))
+        self.assertEqual(tm.objects.count(), tm.tag_count())
+        self.related_helper()
+
+    def test_sharded_stats(self):
+        # the shards of the increments are random
+        random.seed(0)
+        tm = self.taggedmodel = ShardedTagged
+        fieldnames = sorted(tm.taggable_taggedfields)
+        tm.add_tags_bulk([dict(zip(fieldnames, val)) for val in
+                          ComplexTagged.objects.values_list(*fieldnames)])
+        self.cplxtest(self.user, self.category, self.tag,
+            (50, 31, 24, 19, 5, 4, 3, 3))
+        # the shards are summed
+        self.assertEqual(ShardedStatsTagUsr,
+                         tm.explain('tag', user=self.user).model)
+        self.assertEqual(True, tm.explain('tag', user=self.user).aggregate)
+        self.assert_(tm.explain('tag', user=self.user,
+                                qfilter=lambda q: q).fallback)
+        self.assertEqual(False, tm.explain('tag').aggregate)
+        key = {'tag': self.tag, 'user': self.user}
+        before = tm.tag_count(**key)
+        for monster in Monster.objects.all():
+            tm.add_tag(self.tag, user=self.user, category=self.category,
+                       monster=monster)
+        added = tm.tag_count(**key) - before
+        # the increments are spread over the shards
+        self.assert_(ShardedStatsTagUsr.objects.filter(**key).count() > 1)
+        tm.objects.filter(user=self.user, tag=self.tag,
+                          monster__name__icontains='r').delete()
+        removed = before + added - tm.tag_count(**key)
+        self.assert_(added and removed)
+        expected = tm.objects.filter(**key).count()
+        self.assertEqual(expected, tm.tag_count(**key))
+        self.assertEqual(expected, dict([(t.pk, t.count) for t in
+            tm.get_tags(counts=True, user=self.user)])[self.tag.pk])
+        self.assertEqual(dict([(k, 0) for k in tm.taggable_stats]),
+                         tm.rebuild_stats(dry_run=True))
+        shards = list(ShardedStatsTagUsr.objects.filter(**key))
+        self.assertEqual(expected, sum([s.count for s in shards]))
+        folded = tm.compact_stats()
+        self.assertEqual(0,
+            ShardedStatsTagUsr.objects.exclude(shard=0).count())
+        self.assert_(folded[('tag', 'user')] >= len(shards) - 1)
+        self.assertEqual([(0, expected)], list(
+            ShardedStatsTagUsr.objects.filter(**key).values_list('shard',
+                                                                 'count')))
+        self.assertEqual(0, folded[('tag', )])
+        self.cplxtest(self.user, self.category, self.tag,
+            (tm.objects.count(), tm.objects.filter(user=self.user).count(),
+             tm.objects.filter(category=self.category).count(),
+             tm.objects.filter(user=self.user,
+                               category=self.category).count(),
+             tm.objects.filter(tag=self.tag).count(), expected,
+             tm.objects.filter(tag=self.tag,
+                               category=self.category).count(),
+             tm.objects.filter(tag=self.tag, user=self.user,
+                               category=self.category).count()))
+        # the rebuild replaces the shards of the wrong keys
+        ShardedStatsTagUsr.objects.filter(**key).update(count=1)
+        self.assertEqual(1, tm.rebuild_stats()[('tag', 'user')])
+        self.assertEqual(expected, tm.tag_count(**key))
+
+    def _complex_autocomplete(self):
+        tm = self.taggedmodel
+        scopes = [{}, {'user': self.user},
+                  {'user': self.user, 'category': self.category}]
+        prefixes = ['l', 'LV', 'e', 'zz']
+
+        def expected(prefix, top, fields):
+            counts = {}
+            for tag in Tag.objects.filter(pk__in=tm.objects.filter(
+                    tag__name__istartswith=prefix, **fields).values('tag')):
+                counts[tag] = tm.objects.filter(tag=tag, **fields).count()
+            return [(tag.name, count) for tag, count in sorted(
+                counts.items(), key=lambda x: (-x[1], x[0].pk))][:top]
+
+        def check(queries=None):
+            counter = instrumentation.Counter()
+            counter.start()
+            try:
+                results = [(prefix, fields, [(t.name, t.count) for t in
+                            tm.autocomplete(prefix, top=3, **fields)])
+                           for prefix in prefixes for fields in scopes]
+            finally:
+                counter.stop()
+            if queries is not None:
+                self.assertEqual(queries, counter.queries)
+            for prefix, fields, tags in results:
+                self.assertEqual(expected(prefix, 3, fields), tags)
+
+        check()
+        # without top, all the matches are ordered like the indexes
+        for fields in scopes:
+            self.assertEqual(expected('l', None, fields),
+                [(t.name, t.count) for t in tm.autocomplete('l', top=None,
+                                                            **fields)])
+        self.assertEqual(len(expected('', None, {})),
+                         tm.warm_autocomplete())
+        for fields in scopes[1:]:
+            tm.warm_autocomplete(**fields)
+        check(0)
+        records = tm.autocomplete('l', top=None, lightweight=True,
+                                  **scopes[1])
+        self.assertEqual(expected('l', None, scopes[1]),
+                         [(t.name, t.count) for t in records])
+        self.assert_(len(records) > 3)
+        # the indexes follow the changes
+        lvl = Tag.objects.get(name='lvl2')
+        for monster in Monster.objects.all():
+            tm.add_tag(lvl, user=self.user, category=self.category,
+                       monster=monster)
+        tm.add_tag(Tag.objects.create(name='lzz'), user=self.user,
+                   category=self.category, monster=monster)
+        tm.objects.filter(tag__name='large', user=self.user).delete()
+        Tag.objects.get(name='elite').delete()
+        check(0)
+        # expired indexes are reloaded
+        for index in tm.taggable_autocomplete.indexes.values():
+            index.expires = 0
+        check()
+        self.assert_(min([index.expires for index in
+            tm.taggable_autocomplete.indexes.values()]) > 0)
+        self.assertRaises(InvalidFields, tm.warm_autocomplete, zzz=1)
+
+    def _complex_queryset_delete(self):
+        self.taggedmodel.objects.filter(user=self.user,
+                                        monster__name__icontains='r').delete()
+        self.cplxtest(self.user, self.category, self.tag,
+            (31, 12, 5, 0, 2, 1, 0, 0))
+
+    def _complex_tag_counts(self):
+        tm = self.taggedmodel
+        monsters = list(Monster.objects.all())
+        fieldslist = [{}, {'tag': self.tag}, {'user': self.user.pk},
+                      {'tag': self.tag, 'user': self.user,
+                       'category': self.category}]
+        fieldslist += [{'monster': monster, 'tag': self.tag}
+                       for monster in monsters]
+        fieldslist += [{'monster': monster} for monster in monsters]
+        results = tm.tag_counts(fieldslist)
+        self.assertEqual(len(fieldslist), len(results))
+        for fields in fieldslist:
+            self.assertEqual(tm.tag_count(**fields),
+                             results[tuple(sorted(fields.items()))])
+        # cached counts are used for the second call
+        self.assertEqual(results, tm.tag_counts(fieldslist))
+        self.assertEqual({}, tm.tag_counts([]))
+        self.assertRaises(InvalidFields, tm.tag_counts, [{'invalid': 1}])
+
+    def _complex_count_cache(self):
+        tm = self.taggedmodel
+        if tm.taggable_count_cache is None:
+            return
+        monster = Monster.objects.get(name='Vrock')
+        self.assertEqual(5, tm.tag_count(tag=self.tag))
+        self.assertEqual(9, tm.tag_count(monster=monster))
+        # counts are read from the cache
+        StatsTag.objects.filter(tag=self.tag).update(count=42)
+        self.assertEqual(5, tm.tag_count(tag=self.tag))
+        # writes invalidate the cached counts
+        devil = Tag.objects.get(name='devil')
+        tm.add_tag(devil, monster=monster, user=self.user,
+                   category=self.category)
+        self.assertEqual(10, tm.tag_count(monster=monster))
+        self.assertEqual(5, tm.tag_count(tag=self.tag))
+        tm.objects.filter(tag=self.tag, monster=monster).delete()
+        self.assertEqual(40, tm.tag_count(tag=self.tag))
+        self.assertEqual(8, tm.tag_count(monster=monster))
+        self.assertEqual(2, tm.tag_count(tag=self.tag, user=self.user,
+                                         category=self.category))
+        # and so does rebuilding the stats tables
+        tm.rebuild_stats()
+        self.assertEqual(3, tm.tag_count(tag=self.tag))
+        # deleting related objects also invalidates the cached counts
+        devil.delete()
+        self.assertEqual(7, tm.tag_count(monster=monster))
+
+    def _complex_rebuild_stats(self):
+        tm = self.taggedmodel
+        if not tm.taggable_stats:
+            self.assertEqual({}, tm.rebuild_stats())
+            return
+        tag = Tag.objects.get(name='devil')
+        # a drifted count, a missing key and an extra key
+        StatsTag.objects.filter(tag=self.tag).update(count=42)
+        StatsTagUsr.objects.filter(tag=tag).delete()
+        StatsTagUsrCat.objects.create(tag=tag, user=self.user,
+                                      category=self.category, count=3)
+        found = []
+        callback = lambda model, val, expected, stored: found.append(
+            (model, val, expected, stored))
+        expected = {('tag', ): 1, ('tag', 'user'): 2,
+                    ('category', 'tag', 'user'): 1}
+        self.assertEqual(expected, tm.rebuild_stats(dry_run=True,
+                                                    callback=callback))
+        self.assertEqual(4, len(found))
+        self.assert_((StatsTag, (self.tag.pk, ), 5, 42) in found)
+        self.assertEqual(42, tm.tag_count(tag=self.tag))
+        self.assertEqual(expected, tm.rebuild_stats())
+        self.assertEqual(dict([(k, 0) for k in expected]),
+                         tm.rebuild_stats())
+        self.cplxtest(self.user, self.category, self.tag,
+            (50, 31, 24, 19, 5, 4, 3, 3))
+        self.assertEqual(0, tm.tag_count(tag=tag, user=self.user,
+                                         category=self.category))
+        # an empty table is rebuilt in chunks
+        keys = ('category', 'tag', 'user')
+        total = StatsTagUsrCat.objects.count()
+        StatsTagUsrCat.objects.all().delete()
+        self.assertEqual(total, tm.rebuild_stats(chunk_size=3)[keys])
+        self.assertEqual(total, StatsTagUsrCat.objects.count())
+        self.assertEqual(dict([(k, 0) for k in expected]),
+                         tm.rebuild_stats(dry_run=True, chunk_size=2))
+        self.cplxtest(self.user, self.category, self.tag,
+            (50, 31, 24, 19, 5, 4, 3, 3))
+
     def _complex_model_get_tags_one_dimension(self):
         monster = Monster.objects.get(name='Zombie')
         expected = [(u'animate', 1), (u'brute', 2), (u'immortal', 1),
@@ -435,6 +1118,179 @@ class TestComplex(TestBase):
         self.get_tags_helper(self.taggedmodel, expected, 2, 3,
                              category=category, monster=monster)
 
+    def _complex_model_get_tags_category(self):
+        category = Category.objects.get(name='Devil')
+        expected = [(u'animate', 1), (u'brute', 1), (u'devil', 2),
+                    (u'humanoid', 1), (u'immortal', 2), (u'large', 1),
+                    (u'lurker', 1), (u'lvl27', 1), (u'lvl3', 1),
+                    (u'medium', 1), (u'skirmisher', 1), (u'tiny', 1)]
+        self.get_tags_helper(self.taggedmodel, expected, 2, 3,
+                             category=category)
+
+    def _complex_explain(self):
+        tm = self.taggedmodel
+        planner._estimates.clear()
+        category = Category.objects.get(name='Devil')
+        monster = Monster.objects.get(name='Imp')
+        if not tm.taggable_stats:
+            self.assert_(tm.explain(category=category).fallback)
+            return
+        self.assertEqual(StatsTagUsr, tm.explain('tag', user=self.user).model)
+        self.assertEqual(False, tm.explain('tag', user=self.user).aggregate)
+        chosen = tm.explain('tag', category=category)
+        self.assertEqual((StatsTagUsrCat, True),
+                         (chosen.model, chosen.aggregate))
+        self.assertEqual('<Plan: StatsTagUsrCat (aggregate)>', repr(chosen))
+        # qfilters can't use the count of aggregated stats
+        self.assert_(tm.explain('tag', category=category,
+                                qfilter=lambda q: q).fallback)
+        self.assert_(tm.explain(category=category).aggregate)
+        self.assertEqual(ComplexTagged, tm.explain(monster=monster).model)
+        self.cplxtest(self.user, self.category, self.tag,
+            (50, 31, 24, 19, 5, 4, 3, 3))
+
+    def _complex_routes(self):
+        tm = self.taggedmodel
+        # 4 fields: 16 combinations for counts and for every listed field
+        self.assertEqual([None, 'category', 'monster', 'tag', 'user'],
+                         sorted(tm.taggable_routes.keys()))
+        for routes in tm.taggable_routes.values():
+            self.assertEqual(16, len(routes))
+        route = planner.route(tm, {'user': self.user}, 'tag')
+        self.assert_(route is planner.route(tm, ['user'], 'tag'))
+        self.assertEqual(('tag', 'user'), route.keys)
+        self.assertEqual(['tag__id', 'tag__name', 'count'],
+                         route.countfields)
+        self.assertRaises(InvalidFields, planner.route, tm, ['invalid'])
+        self.assertRaises(InvalidFields, planner.route, tm, [], 'invalid')
+        self.assertRaises(InvalidFields, tm.tag_count, invalid=True)
+
+    def _complex_instrumentation(self):
+        tm = self.taggedmodel
+        events = []
+
+        def receiver(sender, **kwargs):
+            events.append((sender, kwargs))
+        instrumentation.tagged_operation.connect(receiver)
+        try:
+            category = Category.objects.get(name='Devil')
+            tags = list(tm.get_tags(counts=True, category=category))
+            tm.tag_count(tag=self.tag)
+            fields = {'user': self.user, 'category': self.category,
+                      'monster': Monster.objects.get(name='Imp')}
+            tm.add_tag(self.tag, **fields)
+            tm.update_tags([Tag.objects.get(name='devil')], **fields)
+            qset = tm.objects.filter(user=self.user,
+                                     monster__name__icontains='r')
+            deleted = qset.count()
+            qset.delete()
+        finally:
+            instrumentation.tagged_operation.disconnect(receiver)
+        counter = instrumentation.Counter()
+        counter.start()
+        try:
+            tm.objects.filter(user=self.user).delete()
+        finally:
+            counter.stop()
+        if not tm.taggable_stats:
+            # counting the deleted rows isn't measured
+            self.assertEqual(counter.queries, events[6][1]['queries'])
+        tm.tag_count(user=self.user)
+        self.assertEqual(['get_tagged_fields', 'tag_count', 'save',
+                          'add_tag', 'delete', 'update_tags', 'delete'],
+                         [kwargs['operation'] for _, kwargs in events])
+        for sender, kwargs in events:
+            self.assertEqual(tm, sender)
+            self.assert_(kwargs['queries'] >= 0)
+            self.assert_(kwargs['seconds'] >= 0)
+        get_tags = events[0][1]
+        self.assertEqual((1, len(tags)), (get_tags['queries'],
+                                          get_tags['rows']))
+        self.assertEqual(tm.explain('tag', category=category),
+                         get_tags['plan'])
+        self.assertEqual(None, events[1][1]['rows'])
+        if tm.taggable_stats:
+            self.assertEqual(StatsTag, events[1][1]['plan'].model)
+        else:
+            self.assert_(events[1][1]['plan'].fallback)
+        self.assertEqual([1, 1, 2],
+                         [events[i][1]['rows'] for i in (2, 3, 5)])
+        self.assertEqual((1, deleted),
+                         (events[4][1]['rows'], events[6][1]['rows']))
+        self.assert_(deleted > 1)
+        # the update includes the delete
+        self.assert_(events[5][1]['queries'] > events[4][1]['queries'])
+
+    def _complex_iter_tags(self):
+        tm = self.taggedmodel
+        for fields in ({}, {'user': self.user},
+                       {'category': self.category},
+                       {'monster': Monster.objects.get(name='Zombie')}):
+            expected = sorted([(t.pk, t.name, t.count) for t in
+                               tm.get_tags(counts=True, **fields)])
+            counter = instrumentation.Counter()
+            counter.start()
+            try:
+                tags = [(t.pk, t.name, t.count) for t in
+                        tm.iter_tags(counts=True, chunk_size=3, **fields)]
+            finally:
+                counter.stop()
+            self.assertEqual(expected, tags)
+            self.assertEqual(len(expected) // 3 + 1, counter.queries)
+            self.assertEqual([t[:2] + (None, ) for t in expected],
+                [(t.id, t.name, t.count) for t in
+                 tm.iter_tags(lightweight=True, chunk_size=2, **fields)])
+            self.assertEqual([t for t in expected if t[2] >= 2],
+                [(t.pk, t.name, t.count) for t in
+                 tm.iter_tags(min_count=2, chunk_size=2, **fields)])
+            self.assertEqual(expected,
+                [(t.pk, t.name, t.count) for t in
+                 tm.objects.filter(**fields).iter_tags(counts=True,
+                                                       chunk_size=4)])
+        self.assertEqual(sorted(set(tm.objects.filter(
+            user=self.user).values_list('monster__name', flat=True))),
+            sorted([m.name for m in
+            tm.iter_tagged_fields('monster', chunk_size=2, user=self.user)]))
+        self.assertEqual([], list(tm.objects.none().iter_tags()))
+
+    def _complex_get_tags_page(self):
+        tm = self.taggedmodel
+        for fields in ({}, {'user': self.user},
+                       {'category': self.category},
+                       {'monster': Monster.objects.get(name='Zombie')}):
+            expected = sorted([(t.pk, t.count) for t in
+                               tm.get_tags(counts=True, **fields)],
+                              key=lambda t: (-t[1], t[0]))
+            for tested in (tm, tm.objects.filter(**fields)):
+                kwargs = tested is tm and fields or {}
+                tags, cursor, pages = [], None, 0
+                while True:
+                    page, cursor = tested.get_tags_page(per_page=4,
+                        cursor=cursor, **kwargs)
+                    tags.extend([(t.pk, t.count) for t in page])
+                    pages += 1
+                    if cursor is None:
+                        break
+                self.assertEqual(expected, tags)
+                self.assertEqual(max(1, (len(expected) + 3) // 4), pages)
+        page, cursor = tm.get_tags_page(per_page=2, lightweight=True)
+        self.assertNotEqual(None, cursor)
+        self.assertEqual([(t.id, t.count) for t in
+                          tm.get_tags(top=2, lightweight=True)],
+                         [(t.id, t.count) for t in page])
+        self.assertRaises(InvalidCursor, tm.get_tags_page, cursor='junk')
+        self.assertRaises(InvalidCursor, tm.get_tags_page,
+                          cursor=encode_cursor([1]))
+        self.assertEqual(([], None), tm.objects.none().get_tags_page())
+
+        qset = tm.objects.filter(user=self.user)
+        expected = list(qset.get_tagged_related('monster').order_by('pk'))
+        monsters, cursor = qset.get_tagged_related_page('monster', 3)
+        while cursor is not None:
+            page, cursor = qset.get_tagged_related_page('monster', 3, cursor)
+            monsters.extend(page)
+        self.assertEqual(expected, monsters)
+
     def _complex_model_get_tags_all(self):
         expected = [(u'animate', 2), (u'brute', 5), (u'demon', 3),
                     (u'devil', 2), (u'elemental', 3), (u'elite', 1),
@@ -481,6 +1337,18 @@ class TestComplex(TestBase):
         self.assertRaises(InvalidFields, self.taggedmodel.add_tag,
                           tag, invalid=True)
 
+    def _complex_add_tags_bulk(self):
+        tag = Tag.objects.get(name='devil')
+        rows = [{'tag': tag, 'user': self.user, 'category': self.category,
+                 'monster': monster} for monster in Monster.objects.all()]
+        created, existing = self.taggedmodel.add_tags_bulk(rows)
+        self.assertEqual((len(rows), 0), (created, existing))
+        self.assertEqual(len(rows), self.taggedmodel.tag_count(
+            tag=tag, user=self.user, category=self.category))
+        self.assertEqual(len(rows) + 2, self.taggedmodel.tag_count(tag=tag))
+        self.assertRaises(InvalidFields, self.taggedmodel.add_tags_bulk,
+                          [{'tag': tag, 'monster': rows[0]['monster']}])
+
     def _complex_add_tag(self):
         monster = Monster.objects.get(name='Vrock')
         tag = Tag.objects.get(name='devil')
@@ -493,6 +1361,50 @@ class TestComplex(TestBase):
                 category=self.category)
             self.assertEqual(3, self.taggedmodel.tag_count(tag=tag))
 
+    def _complex_deferred_stats(self):
+        tm = self.taggedmodel
+        tm.taggable_stats_buffer = stats.StatsBuffer(tm, 100, 3600)
+        try:
+            monster = Monster.objects.get(name='Vrock')
+            tag = Tag.objects.get(name='devil')
+            tm.add_tag(tag, monster=monster, user=self.user,
+                       category=self.category)
+            tm.objects.filter(tag=self.tag, user=self.user).delete()
+            if tm.taggable_stats:
+                # the stats tables are updated when flushing
+                self.assertEqual(2, tm.tag_count(tag=tag))
+                self.assertEqual(5, tm.tag_count(tag=self.tag))
+            tm.flush_stats()
+            self.assertEqual(3, tm.tag_count(tag=tag))
+            self.cplxtest(self.user, self.category, self.tag,
+                (47, 28, 22, 17, 1, 0, 0, 0))
+            # reaching the buffer size flushes the buffer
+            tm.taggable_stats_buffer.size = 1
+            tm.objects.filter(tag=tag).delete()
+            self.assertEqual(0, tm.tag_count(tag=tag))
+        finally:
+            tm.taggable_stats_buffer = None
+
+    def _complex_cached_subset_counts(self):
+        tm = self.taggedmodel
+        expected = tm.objects.filter(user=self.user).count()
+        if tm.taggable_stats:
+            # tag_count(user=) is summed from the (tag, user) stats
+            StatsTagUsr.objects.filter(user=self.user).update(count=50)
+            self.assertNotEqual(expected, tm.tag_count(user=self.user))
+            tm.rebuild_stats()
+        self.assertEqual(expected, tm.tag_count(user=self.user))
+        tm.taggable_stats_buffer = stats.StatsBuffer(tm, 100, 3600)
+        try:
+            tm.add_tag(Tag.objects.get(name='devil'),
+                       monster=Monster.objects.get(name='Vrock'),
+                       user=self.user, category=self.category)
+            tm.tag_count(user=self.user)
+            tm.flush_stats()
+            self.assertEqual(expected + 1, tm.tag_count(user=self.user))
+        finally:
+            tm.taggable_stats_buffer = None
+
     def _complex_update_tags_empty(self):
         # testing different ways of clearing the tags
         vals = [('Balor', None),
@@ -533,11 +1445,77 @@ class TestComplex(TestBase):
                  category=self.category).get_tags(
                  qfilter=lambda q: q.order_by('tag__name'))])
 
+    def _complex_update_tags_result(self):
+        monster = Monster.objects.get(name='Balor')
+        tagnames = ['lvl2', 'brute', 'tiny']
+        newtags = [Tag.objects.get(name=name) for name in tagnames]
+        fields = dict(monster=monster, user=self.user,
+                      category=self.category)
+        result = self.taggedmodel.update_tags(newtags + newtags[:1],
+                                              **fields)
+        self.assertEqual(tagnames + tagnames[:1],
+                         [tagged.tag.name for tagged in result])
+        for tag in newtags:
+            self.assertEqual(1, self.taggedmodel.tag_count(tag=tag,
+                                                           **fields))
+        self.assertEqual(3, self.taggedmodel.tag_count(**fields))
+        self.cplxtest(self.user, self.category, self.tag,
+            (46, 27, 20, 15, 4, 3, 2, 2))
+
+    def _complex_update_tags_no_upsert(self):
+        # the UPDATE then INSERT fallback, for databases without upserts
+        saved = stats._upsert_vendor.copy()
+        stats._upsert_vendor[stats.DEFAULT_DB_ALIAS] = None
+        try:
+            self._complex_update_tags_result()
+        finally:
+            stats._upsert_vendor.clear()
+            stats._upsert_vendor.update(saved)
+
     def _complex_update_tags_invalid(self):
         tags = Tag.objects.filter(name='devil')
         self.assertRaises(InvalidFields, self.taggedmodel.update_tags,
                           tags, invalid=True)
 
+    def _complex_prefetch_tags(self):
+        qset = self.taggedmodel.objects.filter(category=self.category)
+        users = qset.prefetch_tags(User.objects.all(), 'user')
+        records = qset.prefetch_tags(User.objects.all(), 'user',
+                                     attr='tagrecords', lightweight=True)
+        for user, record in zip(users, records):
+            self.assertEqual(
+                sorted([tag.name for tag in qset.filter(
+                        user=user).get_tags()]),
+                sorted([tag.name for tag in user.tags]))
+            self.assertEqual(
+                sorted([(tag.pk, tag.name) for tag in user.tags]),
+                sorted([(tag.id, tag.name) for tag in record.tagrecords]))
+            for tag in record.tagrecords:
+                self.assertEqual(Tag.taggable_record, type(tag))
+
+    def _complex_related_tags(self):
+        self.taggedmodel.rebuild_cooccurrence()
+        self.related_helper()
+        tag = Tag.objects.get(name='devil')
+        self.taggedmodel.add_tags_bulk([{'tag': tag, 'user': self.user,
+            'category': self.category, 'monster': monster}
+            for monster in Monster.objects.all()])
+        self.related_helper()
+        self.taggedmodel.objects.filter(user=self.user,
+                                        monster__name__icontains='r').delete()
+        self.related_helper()
+        self.tag.delete()
+        self.related_helper()
+
+    def _complex_tagged_with(self):
+        qset = self.taggedmodel.objects.filter(user=self.user)
+        for fieldname in ('monster', 'user', 'category'):
+            for tagnames in (['brute', 'undead'], ['humanoid'],
+                             ['demon', 'large', 'elemental']):
+                self.tagged_with_helper(qset, fieldname, tagnames)
+                self.tagged_with_helper(self.taggedmodel.objects.all(),
+                                        fieldname, tagnames)
+
     def _complex_get_tagged_related(self):
         qset = self.taggedmodel.objects.filter(monster__name__icontains='z',
                                                user__name__icontains='a')